@@ -0,0 +1 @@
+""" Pymaginopolis: benchmarks """
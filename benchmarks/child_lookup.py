@@ -0,0 +1,43 @@
+"""
+Benchmark resolving every child reference in a large chunky file
+
+Usage: python -m benchmarks.child_lookup
+"""
+from benchmarks.common import make_chunky_file, best_time
+
+CHUNK_COUNTS = [1000, 5000, 50000]
+
+# Only run the linear scan for small files: it is quadratic
+MAX_LINEAR_SCAN_CHUNKS = 5000
+
+
+def resolve_children(chunky_file):
+    """ Look up every child of every chunk using the chunky file index """
+    for chunk in chunky_file.chunks:
+        for child in chunk.children:
+            _ = chunky_file[child.ref]
+
+
+def resolve_children_linear_scan(chunky_file):
+    """ Look up every child of every chunk by scanning the list of chunks """
+    for chunk in chunky_file.chunks:
+        for child in chunk.children:
+            _ = [c for c in chunky_file.chunks if c.chunk_id == child.ref]
+
+
+def main():
+    print("%10s %10s %14s %18s" % ("chunks", "children", "indexed (ms)", "linear scan (ms)"))
+    for number_of_chunks in CHUNK_COUNTS:
+        chunky_file = make_chunky_file(number_of_chunks, data_size=0)
+        number_of_children = sum(len(c.children) for c in chunky_file.chunks)
+
+        indexed_time = best_time(lambda: resolve_children(chunky_file))
+        if number_of_chunks <= MAX_LINEAR_SCAN_CHUNKS:
+            linear_scan_time = "%.2f" % (best_time(lambda: resolve_children_linear_scan(chunky_file), repeat=1) * 1000)
+        else:
+            linear_scan_time = "-"
+        print("%10d %10d %14.2f %18s" % (number_of_chunks, number_of_children, indexed_time * 1000, linear_scan_time))
+
+
+if __name__ == "__main__":
+    main()
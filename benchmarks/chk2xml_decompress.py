@@ -0,0 +1,58 @@
+"""
+Benchmark converting a chunky file with compressed chunks to XML + decompressed chunk data files, with different
+numbers of worker processes
+
+Uses BLDGHD.CHK from PYMAGINOPOLIS_UNITTEST_DATA if it is set, or a generated file otherwise.
+
+Usage: python -m benchmarks.chk2xml_decompress
+"""
+import os
+import pathlib
+import tempfile
+import time
+
+import pymaginopolis.chunkyfile.codecs as codecs
+import pymaginopolis.chunkyfile.loader as loader
+import pymaginopolis.chunkyfile.model as model
+from benchmarks.common import make_compressed_data
+from pymaginopolis.chunkyfile.chunkxml import chunky_file_to_xml
+
+NUMBER_OF_CHUNKS = 64
+CHUNK_SIZE = 0x20000
+WORKER_COUNTS = [1, 2, 4, 8]
+
+
+def generate_file():
+    """ Generate a chunky file full of compressed chunks """
+    chunks = []
+    for i in range(0, NUMBER_OF_CHUNKS):
+        compression_type = codecs.CompressionType.KCD2 if i % 2 else codecs.CompressionType.KCDC
+        data = make_compressed_data(CHUNK_SIZE, compression_type, seed=i)
+        chunks.append(model.Chunk("MBMP", i, flags=model.ChunkFlags.Compressed, data=data))
+    return model.ChunkyFile(model.Endianness.LittleEndian, model.CharacterSet.ANSI, chunks=chunks)
+
+
+def main():
+    data_path = os.environ.get("PYMAGINOPOLIS_UNITTEST_DATA")
+    if data_path and (pathlib.Path(data_path) / "BLDGHD.CHK").is_file():
+        chunky_file = loader.load_from_path(pathlib.Path(data_path) / "BLDGHD.CHK")
+    else:
+        chunky_file = generate_file()
+
+    compressed_chunks = [c for c in chunky_file.chunks if c.flags & model.ChunkFlags.Compressed]
+    print("%d chunks, %d compressed, %d bytes of compressed data" % (
+        len(chunky_file.chunks), len(compressed_chunks), sum(len(c.encoded_data) for c in compressed_chunks)))
+    print("%8s %10s %10s" % ("workers", "time (s)", "speedup"))
+    baseline = None
+    for workers in WORKER_COUNTS:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            start = time.perf_counter()
+            chunky_file_to_xml(chunky_file, temp_dir, decompress=True, workers=workers)
+            elapsed = time.perf_counter() - start
+
+        baseline = baseline or elapsed
+        print("%8d %10.2f %10.2f" % (workers, elapsed, baseline / elapsed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,41 @@
+"""
+Compare the memory used per chunk by a ChunkTable against a ChunkyFile holding Chunk objects.
+Chunk data is not loaded in either case.
+
+Usage: python -m benchmarks.chunk_table_memory
+"""
+import io
+import tracemalloc
+
+import pymaginopolis.chunkyfile.loader as loader
+from benchmarks.common import make_chunky_file_data
+
+CHUNK_COUNTS = [1000, 10000, 50000]
+
+
+def measure(load):
+    """ Measure the memory still allocated after calling load(). Returns (current, peak) in bytes. """
+    tracemalloc.start()
+    result = load()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return current, peak
+
+
+def main():
+    print("%10s %22s %22s" % ("chunks", "Chunk objects (B/chunk)", "ChunkTable (B/chunk)"))
+    for number_of_chunks in CHUNK_COUNTS:
+        file_data = make_chunky_file_data(number_of_chunks, data_size=16)
+
+        model_current, model_peak = measure(lambda: loader.load_from_file(io.BytesIO(file_data), lazy=True))
+        table_current, table_peak = measure(lambda: loader.load_chunk_table(io.BytesIO(file_data)))
+
+        print("%10d %11.1f (peak %5.1f) %11.1f (peak %5.1f)" % (
+            number_of_chunks,
+            model_current / number_of_chunks, model_peak / number_of_chunks,
+            table_current / number_of_chunks, table_peak / number_of_chunks))
+
+
+if __name__ == "__main__":
+    main()
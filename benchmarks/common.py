@@ -0,0 +1,119 @@
+import io
+import pathlib
+import random
+import time
+
+import pymaginopolis.chunkyfile.codecs as codecs
+import pymaginopolis.chunkyfile.loader as loader
+import pymaginopolis.chunkyfile.model as model
+import pymaginopolis.chunkyfile.writer as writer
+
+# Tags that are common in 3DMM content files
+SYNTHETIC_TAGS = ["GLOP", "GLSC", "GST ", "MBMP", "WAVE", "TMPL", "BMDL", "CAM "]
+
+
+def load_corpus(data_path, chunk_filter=None, encoded=False):
+    """
+    Load chunk data from every chunky file in a directory
+    :param data_path: directory containing chunky files. Other files are skipped.
+    :param chunk_filter: function that returns True for each chunk whose data should be loaded. Defaults to all chunks.
+    :param encoded: load the data as it is stored in the file instead of decompressing it
+    :return: list of chunk data
+    """
+    corpus = []
+    for file_path in pathlib.Path(data_path).glob("*"):
+        if not file_path.is_file():
+            continue
+        with open(file_path, "rb") as chunky_file:
+            if chunky_file.read(4) != b'CHN2':
+                continue
+            chunky_file.seek(0)
+            this_file = loader.load_from_file(chunky_file)
+            chunks = [c for c in this_file.chunks if chunk_filter is None or chunk_filter(c)]
+            corpus.extend(bytes(c.encoded_data if encoded else c.decoded_data) for c in chunks)
+    return corpus
+
+
+def make_chunky_file(number_of_chunks, data_size=64, children_per_chunk=2, seed=0):
+    """
+    Generate a chunky file full of synthetic chunks
+    :param number_of_chunks: number of chunks to generate
+    :param data_size: size of the data for each chunk
+    :param children_per_chunk: number of children each chunk has. Children are always chunks created earlier.
+    :param seed: random seed
+    :return: ChunkyFile
+    """
+    rng = random.Random(seed)
+    chunks = []
+    for i in range(0, number_of_chunks):
+        tag = SYNTHETIC_TAGS[i % len(SYNTHETIC_TAGS)]
+        data = bytes(rng.getrandbits(8) for _ in range(0, data_size))
+        name = "chunk %d" % i if i % 4 == 0 else None
+        children = []
+        if i > 0:
+            for chid in range(0, children_per_chunk):
+                child = chunks[rng.randrange(0, i)]
+                children.append(model.ChunkChild(chid, child.chunk_id))
+        chunks.append(model.Chunk(tag, i, name=name, data=data, children=children))
+
+    return model.ChunkyFile(model.Endianness.LittleEndian, model.CharacterSet.ANSI, chunks=chunks)
+
+
+def make_chunky_file_data(number_of_chunks, **kwargs):
+    """ Generate a synthetic chunky file and serialize it. Returns the file as bytes. """
+    output = io.BytesIO()
+    writer.write_to_file(make_chunky_file(number_of_chunks, **kwargs), output)
+    return output.getvalue()
+
+
+def make_compressed_data(decompressed_size, compression_type=codecs.CompressionType.KCDC, seed=0):
+    """
+    Generate compressed data from a random mix of literals and back-references
+    :param decompressed_size: size of the data when it is decompressed
+    :param compression_type: KCDC or KCD2
+    :param seed: random seed
+    :return: compressed data, starting with a compression header
+    """
+    rng = random.Random(seed)
+    bit_writer = codecs.BitWriter()
+    out_pos = 0
+    while out_pos < decompressed_size:
+        remaining = decompressed_size - out_pos
+        if out_pos == 0 or remaining < 3 or rng.random() < 0.3:
+            if compression_type == codecs.CompressionType.KCD2:
+                length = rng.randrange(1, min(remaining, 16) + 1)
+                bit_writer.write(0, 1)
+                codecs._write_length(bit_writer, length)
+            else:
+                length = 1
+            for _ in range(0, length):
+                if compression_type == codecs.CompressionType.KCDC:
+                    bit_writer.write(0, 1)
+                bit_writer.write(rng.getrandbits(8), 8)
+            out_pos += length
+            continue
+
+        offset = rng.randrange(1, min(out_pos, 0x8000) + 1)
+        prefix, prefix_size, offset_bits, min_offset = [c for c in codecs.KCDC_OFFSET_CLASSES if c[3] <= offset][-1]
+        extra_length = 2 if min_offset == 0x1241 else 1
+        length = rng.randrange(extra_length + 1, min(remaining, 64) + 1)
+
+        bit_writer.write(prefix, prefix_size)
+        bit_writer.write(offset - min_offset, offset_bits)
+        codecs._write_length(bit_writer, length - extra_length)
+        out_pos += length
+
+    bit_writer.write(0b1111, 4)
+    bit_writer.write(codecs.KCDC_END_OF_STREAM, 20)
+    header = codecs.COMPRESSION_HEADER.pack(compression_type.name.encode("ascii"), decompressed_size, 0)
+    return header + bit_writer.flush() + codecs.COMPRESSION_TAIL
+
+
+def best_time(func, repeat=5):
+    """ Run a function several times and return the fastest time in seconds """
+    times = []
+    for _ in range(0, repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
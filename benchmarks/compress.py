@@ -0,0 +1,47 @@
+"""
+Benchmark compressing chunk data at each compression level (compression ratio and MB/s of input)
+
+Chunk data is loaded from the chunky files in PYMAGINOPOLIS_UNITTEST_DATA if it is set, or generated otherwise.
+
+Usage: python -m benchmarks.compress
+"""
+import os
+import random
+import time
+
+import pymaginopolis.chunkyfile.codecs as codecs
+from benchmarks.common import load_corpus
+
+WORDS = [b"movie", b"actor", b"scene", b"camera", b"3D", b"maker", b"the", b"a", b"prop", b"sound", b"talk"]
+
+
+def generate_corpus():
+    """ Generate text, bitmap-like and noisy chunk data """
+    rng = random.Random(0)
+    text = b" ".join(rng.choice(WORDS) for _ in range(0, 0x4000))
+    rows = [bytes(rng.choice([0, 0, 0, 1, 2, 3]) for _ in range(0, 64)) for _ in range(0, 16)]
+    bitmap = b"".join(rng.choice(rows) for _ in range(0, 0x400))
+    noisy = bytes(rng.choice(b"\x00\x00\x00\x00\xFF") if rng.random() < 0.9 else rng.getrandbits(8)
+                  for _ in range(0, 0x10000))
+    return [text, bitmap, noisy]
+
+
+def main():
+    data_path = os.environ.get("PYMAGINOPOLIS_UNITTEST_DATA")
+    corpus = load_corpus(data_path) if data_path else generate_corpus()
+    input_size = sum(len(c) for c in corpus)
+
+    print("input: %d chunks, %d bytes" % (len(corpus), input_size))
+    print("%6s %8s %12s %8s %10s" % ("type", "level", "compressed", "ratio", "MB/s"))
+    for compression_type in [codecs.CompressionType.KCDC, codecs.CompressionType.KCD2]:
+        for level in codecs.CompressionLevel:
+            start = time.perf_counter()
+            compressed_size = sum(len(codecs.compress(c, compression_type, level)) for c in corpus)
+            elapsed = time.perf_counter() - start
+
+            print("%6s %8s %12d %8.3f %10.2f" % (compression_type.name, level.name, compressed_size,
+                                                 compressed_size / input_size, input_size / elapsed / 1000000))
+
+
+if __name__ == "__main__":
+    main()
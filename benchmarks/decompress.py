@@ -0,0 +1,46 @@
+"""
+Benchmark decompressing compressed chunks (MB/s of decompressed output)
+
+Compressed chunks are loaded from the chunky files in PYMAGINOPOLIS_UNITTEST_DATA if it is set, or generated otherwise.
+
+Usage: python -m benchmarks.decompress
+"""
+import os
+import time
+
+import pymaginopolis.chunkyfile.codecs as codecs
+import pymaginopolis.chunkyfile.model as model
+from benchmarks.common import load_corpus, make_compressed_data
+
+SYNTHETIC_CHUNK_SIZES = [0x1000, 0x10000, 0x100000]
+
+
+def generate_corpus():
+    return [make_compressed_data(size, compression_type, seed=size)
+            for compression_type in [codecs.CompressionType.KCDC, codecs.CompressionType.KCD2]
+            for size in SYNTHETIC_CHUNK_SIZES for _ in range(0, 4)]
+
+
+def main():
+    data_path = os.environ.get("PYMAGINOPOLIS_UNITTEST_DATA")
+    if data_path:
+        corpus = load_corpus(data_path, lambda c: c.flags & model.ChunkFlags.Compressed, encoded=True)
+    else:
+        corpus = generate_corpus()
+
+    print("%6s %8s %14s %14s %10s" % ("type", "chunks", "compressed", "decompressed", "MB/s"))
+    for compression_type in [codecs.CompressionType.KCDC, codecs.CompressionType.KCD2]:
+        chunks = [c for c in corpus if codecs.identify_compression(c) == compression_type]
+        if not chunks:
+            continue
+
+        start = time.perf_counter()
+        decompressed_size = sum(len(codecs.decompress(c)) for c in chunks)
+        elapsed = time.perf_counter() - start
+
+        print("%6s %8d %14d %14d %10.2f" % (compression_type.name, len(chunks), sum(len(c) for c in chunks),
+                                            decompressed_size, decompressed_size / elapsed / 1000000))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""
+Benchmark disassembling every script in a corpus of chunky files: throughput and memory per instruction.
+
+Scripts are loaded from the GLOP/GLSC chunks of the chunky files in PYMAGINOPOLIS_UNITTEST_DATA if it is set, or
+generated otherwise.
+
+Usage: python -m benchmarks.disassemble
+"""
+import io
+import os
+import random
+import time
+import tracemalloc
+
+import pymaginopolis.scriptengine.assembler as assembler
+import pymaginopolis.scriptengine.disassembler as disassembler
+import pymaginopolis.scriptengine.model as scriptmodel
+from benchmarks.common import load_corpus
+
+SCRIPT_CHUNK_TAGS = {"GLOP", "GLSC"}
+NUMBER_OF_SYNTHETIC_SCRIPTS = 2000
+INSTRUCTIONS_PER_SYNTHETIC_SCRIPT = 100
+
+
+def generate_corpus(seed=0):
+    """ Generate scripts with a mix of variable and fixed instructions """
+    rng = random.Random(seed)
+    corpus = []
+    for _ in range(0, NUMBER_OF_SYNTHETIC_SCRIPTS):
+        script = scriptmodel.Script()
+        for _ in range(0, INSTRUCTIONS_PER_SYNTHETIC_SCRIPT):
+            if rng.random() < 0.3:
+                instruction = scriptmodel.Instruction(rng.randrange(1, 8), variable="siiLoop")
+            else:
+                params = [rng.getrandbits(32) for _ in range(0, rng.randrange(0, 4))]
+                instruction = scriptmodel.Instruction(rng.randrange(0x100, 0x200), params=params)
+            script.instructions.append(instruction)
+        corpus.append(assembler.assemble_script(script))
+    return corpus
+
+
+def main():
+    data_path = os.environ.get("PYMAGINOPOLIS_UNITTEST_DATA")
+    if data_path:
+        corpus = load_corpus(data_path, lambda c: c.chunk_id.tag in SCRIPT_CHUNK_TAGS)
+    else:
+        corpus = generate_corpus()
+
+    # Throughput
+    start = time.perf_counter()
+    scripts = [disassembler.disassemble_script(io.BytesIO(script_data)) for script_data in corpus]
+    elapsed = time.perf_counter() - start
+    number_of_instructions = sum(len(s.instructions) for s in scripts)
+    del scripts
+
+    # Memory held by the disassembled scripts
+    tracemalloc.start()
+    scripts = [disassembler.disassemble_script(io.BytesIO(script_data)) for script_data in corpus]
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print("Scripts:           %d" % len(corpus))
+    print("Instructions:      %d" % number_of_instructions)
+    print("Time:              %.2f s" % elapsed)
+    print("Instructions/s:    %.0f" % (number_of_instructions / elapsed))
+    print("Bytes/instruction: %.1f" % (current / number_of_instructions))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,27 @@
+"""
+Benchmark parsing the index of a chunky file as the number of chunks grows
+
+Usage: python -m benchmarks.index_parse
+"""
+import io
+
+import pymaginopolis.chunkyfile.loader as loader
+from benchmarks.common import make_chunky_file_data, best_time
+
+CHUNK_COUNTS = [1000, 5000, 10000, 50000]
+
+
+def main():
+    print("%10s %12s %14s" % ("chunks", "parse (ms)", "per chunk (us)"))
+    for number_of_chunks in CHUNK_COUNTS:
+        file_data = make_chunky_file_data(number_of_chunks, data_size=16)
+
+        def parse_index():
+            loader.load_from_file(io.BytesIO(file_data), lazy=True)
+
+        elapsed = best_time(parse_index)
+        print("%10d %12.2f %14.2f" % (number_of_chunks, elapsed * 1000, elapsed * 1000000 / number_of_chunks))
+
+
+if __name__ == "__main__":
+    main()
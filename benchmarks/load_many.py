@@ -0,0 +1,41 @@
+"""
+Benchmark loading a directory of chunky files with different numbers of worker processes
+
+Usage: python -m benchmarks.load_many
+"""
+import pathlib
+import tempfile
+import time
+
+import pymaginopolis.chunkyfile.batch as batch
+from benchmarks.common import make_chunky_file_data
+
+NUMBER_OF_FILES = 16
+CHUNKS_PER_FILE = 10000
+WORKER_COUNTS = [1, 2, 4, 8]
+
+
+def main():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        file_data = make_chunky_file_data(CHUNKS_PER_FILE, data_size=32)
+        paths = []
+        for i in range(0, NUMBER_OF_FILES):
+            path = pathlib.Path(temp_dir) / ("synthetic%d.chk" % i)
+            path.write_bytes(file_data)
+            paths.append(path)
+
+        print("%d files, %d chunks each" % (NUMBER_OF_FILES, CHUNKS_PER_FILE))
+        print("%8s %10s %10s" % ("workers", "time (s)", "speedup"))
+        baseline = None
+        for workers in WORKER_COUNTS:
+            start = time.perf_counter()
+            results = batch.load_many(paths, workers=workers)
+            elapsed = time.perf_counter() - start
+            assert all(r.ok for r in results)
+
+            baseline = baseline or elapsed
+            print("%8d %10.2f %10.2f" % (workers, elapsed, baseline / elapsed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""
+Benchmark rebuilding a large template with one modified chunk: loading the whole template and writing every chunk,
+compared to loading it lazily and copying unmodified chunk data straight from the template
+
+Usage: python -m benchmarks.template_passthrough
+"""
+import pathlib
+import tempfile
+import time
+import tracemalloc
+
+import pymaginopolis.chunkyfile.loader as loader
+import pymaginopolis.chunkyfile.writer as writer
+from benchmarks.common import make_chunky_file_data
+
+NUMBER_OF_CHUNKS = 2000
+CHUNK_SIZE = 0x8000
+
+
+def rebuild(template_path, output_path, passthrough):
+    """ Load the template, modify one chunk and write the result """
+    if passthrough:
+        with loader.load_from_path(template_path, lazy=True) as chunky_file:
+            chunky_file.chunks[0].raw_data = b'modified'
+            with open(template_path, "rb") as template_file, open(output_path, "wb") as output_file:
+                writer.write_to_file(chunky_file, output_file, template=template_file)
+    else:
+        chunky_file = loader.load_from_path(template_path)
+        chunky_file.chunks[0].raw_data = b'modified'
+        with open(output_path, "wb") as output_file:
+            writer.write_to_file(chunky_file, output_file)
+
+
+def main():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        template_path = pathlib.Path(temp_dir) / "template.chk"
+        template_path.write_bytes(make_chunky_file_data(NUMBER_OF_CHUNKS, data_size=CHUNK_SIZE, children_per_chunk=1))
+        print("template: %d chunks, %d bytes" % (NUMBER_OF_CHUNKS, template_path.stat().st_size))
+
+        outputs = []
+        print("%12s %10s %16s" % ("mode", "time (s)", "peak memory (MB)"))
+        for passthrough in [False, True]:
+            output_path = pathlib.Path(temp_dir) / ("output%d.chk" % passthrough)
+            tracemalloc.start()
+            start = time.perf_counter()
+            rebuild(template_path, output_path, passthrough)
+            elapsed = time.perf_counter() - start
+            peak_memory = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+            outputs.append(output_path.read_bytes())
+            print("%12s %10.2f %16.1f" % ("passthrough" if passthrough else "full", elapsed, peak_memory / 1000000))
+
+        assert outputs[0] == outputs[1]
+
+
+if __name__ == "__main__":
+    main()
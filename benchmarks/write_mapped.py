@@ -0,0 +1,63 @@
+"""
+Benchmark writing a large chunky file serially with write_to_file, and through a memory mapped output with
+write_mapped using different numbers of threads. Chunk data comes from memory, and from a template file.
+
+Usage: python -m benchmarks.write_mapped
+"""
+import pathlib
+import tempfile
+import time
+
+import pymaginopolis.chunkyfile.loader as loader
+import pymaginopolis.chunkyfile.writer as writer
+from benchmarks.common import make_chunky_file_data
+
+NUMBER_OF_CHUNKS = 4096
+CHUNK_SIZE = 0x10000
+JOB_COUNTS = [1, 2, 4]
+
+
+def time_write(write, output_path, mode):
+    start = time.perf_counter()
+    with open(output_path, mode) as output_file:
+        write(output_file)
+    return time.perf_counter() - start
+
+
+def main():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        template_path = pathlib.Path(temp_dir) / "template.chk"
+        template_path.write_bytes(make_chunky_file_data(NUMBER_OF_CHUNKS, data_size=CHUNK_SIZE, children_per_chunk=1))
+        output_path = pathlib.Path(temp_dir) / "output.chk"
+        print("%d chunks, %d bytes" % (NUMBER_OF_CHUNKS, template_path.stat().st_size))
+
+        chunky_file = loader.load_from_path(template_path)
+        template_file = open(template_path, "rb")
+
+        def write_from_template(write, mode):
+            # Saving moves the stored locations of the chunks to the output, so reload the template each time
+            lazy_file = loader.load_from_path(template_path, lazy=True)
+            elapsed = time_write(lambda f: write(lazy_file, f), output_path, mode)
+            lazy_file.close()
+            return elapsed
+
+        print("%10s %8s %12s %14s" % ("writer", "jobs", "memory (s)", "template (s)"))
+        memory_time = time_write(lambda f: writer.write_to_file(chunky_file, f), output_path, "wb")
+        expected = output_path.read_bytes()
+        template_time = write_from_template(lambda c, f: writer.write_to_file(c, f, template=template_file), "wb")
+        assert output_path.read_bytes() == expected
+        print("%10s %8s %12.2f %14.2f" % ("serial", "-", memory_time, template_time))
+
+        for jobs in JOB_COUNTS:
+            memory_time = time_write(lambda f: writer.write_mapped(chunky_file, f, jobs=jobs), output_path, "w+b")
+            assert output_path.read_bytes() == expected
+            template_time = write_from_template(
+                lambda c, f: writer.write_mapped(c, f, template=template_file, jobs=jobs), "w+b")
+            assert output_path.read_bytes() == expected
+            print("%10s %8d %12.2f %14.2f" % ("mapped", jobs, memory_time, template_time))
+
+        template_file.close()
+
+
+if __name__ == "__main__":
+    main()
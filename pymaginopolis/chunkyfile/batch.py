@@ -0,0 +1,106 @@
+""" Pymaginopolis: load many chunky files and decompress many chunks in parallel """
+import os
+import pathlib
+from collections import namedtuple, deque
+from concurrent.futures import ProcessPoolExecutor
+
+import pymaginopolis.chunkyfile.codecs as codecs
+import pymaginopolis.chunkyfile.loader as loader
+
+CHUNKY_FILE_EXTENSIONS = {".3mm", ".3th", ".3cn",  # 3DMM
+                          ".nmm", ".nth", ".1mm",  # Nickelodeon 3DMM
+                          ".ath", ".bth", ".gth", ".mth", ".tth",  # Creative Writer 2
+                          ".chk",  # Generic
+                          }
+
+
+class LoadResult(namedtuple("LoadResult", field_names=["path", "result", "error"])):
+    """ Result of loading one file: either a ChunkTable or ChunkyFile, or an error message """
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+def summarize_file(path):
+    """
+    Read the index of a chunky file into a ChunkTable that can be sent between processes
+    :param path: path to the chunky file
+    :return: ChunkTable without a data source
+    """
+    with open(path, "rb") as file:
+        table = loader.load_chunk_table(file)
+    table.data_source = None
+    return table
+
+
+def _load_one(path, full):
+    """ Load or summarize one file, catching errors so that they can be reported with the other results """
+    try:
+        result = loader.load_from_path(path) if full else summarize_file(path)
+        return LoadResult(str(path), result, None)
+    except Exception as e:
+        return LoadResult(str(path), None, "%s: %s" % (type(e).__name__, e))
+
+
+def load_many(paths, workers=None, full=False):
+    """
+    Load several chunky files in a pool of processes
+    :param paths: list of paths to chunky files
+    :param workers: number of worker processes. Defaults to the number of CPUs. If 1, files are loaded in this process.
+    :param full: if True, load each file into a ChunkyFile with all chunk data. Otherwise, return a ChunkTable with the
+                 attributes of each chunk.
+    :return: list of LoadResult, in the same order as paths
+    """
+    paths = list(paths)
+    if workers == 1:
+        return [_load_one(path, full) for path in paths]
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(_load_one, paths, [full] * len(paths)))
+
+
+def _decompress_or_error(data):
+    """ Decompress data, returning the CompressionException instead of raising it if the data can't be decompressed """
+    try:
+        return codecs.decompress(data)
+    except codecs.CompressionException as e:
+        return e
+
+
+def decompress_many(compressed_data, workers=None, max_pending=None, catch_errors=False):
+    """
+    Decompress chunk data in a pool of processes. Results are returned as soon as they are ready, in order, with a
+    limited number of chunks in flight so that a large file does not have to be held in memory twice.
+    :param compressed_data: iterable of compressed chunk data
+    :param workers: number of worker processes. Defaults to the number of CPUs. If 1, data is decompressed in this
+                    process.
+    :param max_pending: maximum number of chunks being decompressed at once. Defaults to four per worker.
+    :param catch_errors: if True, the CompressionException for data that can't be decompressed is returned in place of
+                         its result, instead of being raised
+    :return: iterator of decompressed data, in the same order as compressed_data
+    """
+    decompress = _decompress_or_error if catch_errors else codecs.decompress
+    if workers == 1:
+        for data in compressed_data:
+            yield decompress(data)
+        return
+
+    workers = workers or os.cpu_count() or 1
+    max_pending = max_pending or workers * 4
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for data in compressed_data:
+            # Memory views can't be sent to another process
+            pending.append(pool.submit(decompress, bytes(data)))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
+
+
+def find_chunky_files(directory):
+    """ Find files with chunky file extensions in a directory and its subdirectories """
+    return sorted(p for p in pathlib.Path(directory).rglob("*")
+                  if p.is_file() and p.suffix.lower() in CHUNKY_FILE_EXTENSIONS)
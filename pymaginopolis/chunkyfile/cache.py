@@ -0,0 +1,76 @@
+""" Pymaginopolis: cache of decoded chunk data """
+from collections import OrderedDict, namedtuple
+
+# Approximate maximum number of bytes of decoded chunk data to keep in the cache
+DEFAULT_DECODED_CACHE_SIZE = 0x2000000
+
+CacheEntry = namedtuple("CacheEntry", field_names=["version", "value", "size"])
+
+
+class DecodedDataCache:
+    """
+    Least recently used cache of decoded chunk data, eg. decompressed chunk data or parsed string tables.
+    The cache is bounded by the approximate size of the cached values in bytes.
+    """
+
+    def __init__(self, max_size=DEFAULT_DECODED_CACHE_SIZE):
+        """
+        :param max_size: approximate maximum number of bytes of decoded data to keep
+        """
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __str__(self):
+        return "DecodedDataCache: %d entries, 0x%x/0x%x bytes, %d hits, %d misses, %d evictions" % (
+            len(self._entries), self.size, self.max_size, self.hits, self.misses, self.evictions)
+
+    def get(self, key, version, load):
+        """
+        Get a value from the cache, loading it if it is not cached or if the cached value is out of date
+        :param key: hashable key of the value
+        :param version: the cached value is only used if it was loaded with an equal version
+        :param load: function that returns a tuple of (value, approximate size in bytes)
+        :return: value
+        """
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry.version == version:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return entry.value
+
+            # Out of date
+            self._remove(key)
+
+        self.misses += 1
+        value, size = load()
+        if size <= self.max_size:
+            self._entries[key] = CacheEntry(version, value, size)
+            self.size += size
+            while self.size > self.max_size:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+        return value
+
+    def discard(self, match):
+        """
+        Remove cached values
+        :param match: function that returns True for the keys to remove
+        """
+        for key in [k for k in self._entries if match(k)]:
+            self._remove(key)
+
+    def clear(self):
+        """ Remove all cached values. The counters are not reset. """
+        self._entries.clear()
+        self.size = 0
+
+    def _remove(self, key):
+        self.size -= self._entries.pop(key).size
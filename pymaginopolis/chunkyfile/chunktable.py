@@ -0,0 +1,103 @@
+""" Pymaginopolis: compact chunk index for very large chunky files """
+from array import array
+
+import pymaginopolis.chunkyfile.model as model
+from pymaginopolis.chunkyfile.common import tag_bytes_to_string
+
+
+def tag_code_to_string(tag_code):
+    """ Convert a tag stored as a 32-bit little-endian integer into a string """
+    return tag_bytes_to_string(tag_code.to_bytes(4, "little"))
+
+
+class ChunkTable:
+    """
+    Chunk attributes stored as a set of parallel arrays instead of one Chunk object per chunk.
+    Chunk objects are created on demand when the table is indexed.
+    """
+
+    def __init__(self, file_type, endianness, characterset, data_source=None):
+        self.file_type = file_type
+        self.endianness = endianness
+        self.characterset = characterset
+        # Object with a read(offset, size) method to read chunk data from
+        self.data_source = data_source
+
+        # One entry per chunk
+        self.tag_codes = array("I")
+        self.numbers = array("I")
+        self.offsets = array("I")
+        self.sizes = array("I")
+        self.flags = array("B")
+        # Children of chunk n are at child_starts[n]:child_starts[n+1] in the child arrays
+        self.child_starts = array("I", [0])
+
+        # One entry per child
+        self.child_tag_codes = array("I")
+        self.child_numbers = array("I")
+        self.child_chids = array("I")
+
+        # Most chunks don't have names, so only store the ones that do
+        self.names = {}
+
+    def __len__(self):
+        return len(self.numbers)
+
+    def __str__(self):
+        return "ChunkTable: %s %s/%s - %d chunks" % (
+            self.file_type, self.endianness.name, self.characterset.name, len(self))
+
+    def append(self, tag_code, number, offset, size, flags, children=(), name=None):
+        """
+        Add a chunk to the table
+        :param tag_code: chunk tag as a 32-bit little-endian integer
+        :param number: chunk number
+        :param offset: offset of the chunk data in the file
+        :param size: size of the chunk data
+        :param flags: chunk flags
+        :param children: iterable of (tag code, number, chid) tuples
+        :param name: optional, chunk name
+        """
+        if name:
+            self.names[len(self)] = name
+
+        self.tag_codes.append(tag_code)
+        self.numbers.append(number)
+        self.offsets.append(offset)
+        self.sizes.append(size)
+        self.flags.append(flags)
+
+        for child_tag_code, child_number, child_chid in children:
+            self.child_tag_codes.append(child_tag_code)
+            self.child_numbers.append(child_number)
+            self.child_chids.append(child_chid)
+        self.child_starts.append(len(self.child_chids))
+
+    def chunk_id(self, index):
+        """ Get the chunk ID of a chunk without creating a Chunk object """
+        return model.ChunkId(tag_code_to_string(self.tag_codes[index]), self.numbers[index])
+
+    def children(self, index):
+        """ Get the list of children of a chunk """
+        return [model.ChunkChild(self.child_chids[i],
+                                 model.ChunkId(tag_code_to_string(self.child_tag_codes[i]), self.child_numbers[i]))
+                for i in range(self.child_starts[index], self.child_starts[index + 1])]
+
+    def __getitem__(self, index):
+        """ Create a Chunk for an entry in the table. The chunk data is read when it is accessed. """
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+
+        chunk_id = self.chunk_id(index)
+        chunk = model.Chunk(chunk_id.tag, chunk_id.number, name=self.names.get(index),
+                            flags=model.ChunkFlags(self.flags[index]), children=self.children(index))
+        if self.data_source is not None:
+            chunk.defer_data(self.data_source, self.offsets[index], self.sizes[index])
+            chunk.set_stored_location(self.offsets[index], self.sizes[index], loaded=True)
+        return chunk
+
+    def __iter__(self):
+        for index in range(0, len(self)):
+            yield self[index]
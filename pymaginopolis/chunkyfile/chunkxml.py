@@ -1,104 +1,324 @@
 import base64
+import io
 import logging
+import mmap
+import os
 import pathlib
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from xml.etree import ElementTree
 
-from xml.dom import minidom
-
-from pymaginopolis.chunkyfile import model as model, codecs as codecs
+from pymaginopolis.chunkyfile import model as model, codecs as codecs, batch as batch
 
 EMPTY_FILE = "EmpT"
+XML_DECLARATION = '<?xml version="1.0" ?>\n'
 
 
-def chunky_file_to_xml(this_file, chunk_data_dir=None):
+def chunky_file_to_xml(this_file, chunk_data_dir=None, decompress=False, workers=None, sidecar_path=None,
+                       jobs=1):
     """
     Generate an XML representation of a chunky file
     :param this_file: chunky file object
     :param chunk_data_dir: optional, directory to write chunk data files to
+    :param decompress: if True, write the decompressed data of compressed chunks
+    :param workers: number of processes to decompress chunks with, see batch.decompress_many
+    :param sidecar_path: optional, file to pack all chunk data into
+    :param jobs: number of threads to write chunk data files with, see write_chunky_file_xml
     :return: string containing XML representation of a chunky file
     """
+    output = io.StringIO()
+    write_chunky_file_xml(this_file, output, chunk_data_dir, decompress, workers, sidecar_path, jobs)
+    return output.getvalue()
+
+
+def write_chunky_file_xml(this_file, output, chunk_data_dir=None, decompress=False, workers=None,
+                          sidecar_path=None, jobs=1):
+    """
+    Write an indented XML representation of a chunky file to a text file, one chunk at a time.
+    Chunk data is written inline as base64, to one file per chunk in chunk_data_dir, or packed into a single sidecar
+    file with its offset and size recorded in the XML.
+    :param this_file: chunky file object
+    :param output: text file object to write the XML to
+    :param chunk_data_dir: optional, directory to write chunk data files to
+    :param decompress: if True, write the decompressed data of compressed chunks
+    :param workers: number of processes to decompress chunks with, see batch.decompress_many
+    :param sidecar_path: optional, file to pack all chunk data into. If output is a file on disk, the path is stored
+                         relative to it; otherwise, the absolute path is stored.
+    :param jobs: number of threads to write chunk data files with. If 1, files are written by this thread. More threads
+                 help when writes are slow to complete, eg. on network storage.
+    """
+    logger = logging.getLogger(__name__)
+    start_time = time.perf_counter()
+
+    if chunk_data_dir and sidecar_path:
+        raise ValueError("Chunk data can be written to a directory or to a sidecar file, not both")
+
     if chunk_data_dir:
         chunk_data_dir = pathlib.Path(chunk_data_dir)
         if not chunk_data_dir.is_dir():
             chunk_data_dir.mkdir()
 
-    # Generate XML document
+    # Write the start of the XML document
+    output.write(XML_DECLARATION)
     chunky_root = ElementTree.Element("ChunkyFile")
     chunky_root.set("type", this_file.file_type)
     chunky_root.set("endianness", this_file.endianness.name)
     chunky_root.set("charset", this_file.characterset.name)
+    if sidecar_path:
+        chunky_root.set("sidecar", _make_sidecar_reference(output, sidecar_path))
+    output.write("<%s%s>\n" % (chunky_root.tag, _format_attributes(chunky_root)))
 
-    for chunk in this_file.chunks:
-        chunk_element = ElementTree.SubElement(chunky_root, "Chunk")
-        chunk_element.set("tag", chunk.chunk_id.tag)
-        chunk_element.set("number", str(chunk.chunk_id.number))
-        if chunk.name:
-            chunk_element.set("name", chunk.name)
-        if chunk.flags & model.ChunkFlags.Loner:
-            chunk_element.set("loner", "true")
-
-        # Add children
-        for chunk_child in chunk.children:
-            child_element = ElementTree.SubElement(chunk_element, "Child")
-            child_element.set("chid", str(chunk_child.chid))
-            child_element.set("tag", chunk_child.ref.tag)
-            child_element.set("number", str(chunk_child.ref.number))
-
-        # Add data
-        if chunk.flags & model.ChunkFlags.Compressed:
-            is_compressed = True
-            this_chunk_data = chunk.encoded_data
-            chunk_element.set("compressed", "true")
-        else:
-            is_compressed = False
-            this_chunk_data = chunk.raw_data
-
-        if chunk_data_dir:
-            file_extension = chunk.chunk_id.tag.lower().rstrip(" ")
-
-            # HACK
-            if file_extension == "wave":
-                file_extension = "wav"
-            chunk_data_file_name = "%d.%s" % (chunk.chunk_id.number, file_extension)
-
-            if is_compressed:
-                compression_type = codecs.identify_compression(this_chunk_data).name
-                chunk_data_file_name += ".%s" % (compression_type.lower())
-
-            chunk_data_file_path = chunk_data_dir / chunk_data_file_name
-            with open(chunk_data_file_path, "wb") as chunk_data_file:
-                chunk_data_file.write(this_chunk_data)
-
-            # Create element for data
-            data_element = ElementTree.SubElement(chunk_element, "File")
-            data_element.text = str(chunk_data_file_path)
-            if is_compressed:
-                data_element.set("compressed", "true")
-        else:
-            data_element = ElementTree.SubElement(chunk_element, "Data")
-            data_element.text = base64.b64encode(this_chunk_data).decode("utf-8")
+    if decompress:
+        # Decompress chunks in the background, in the same order as they are written below
+        compressed_chunks = [c for c in this_file.chunks if c.flags & model.ChunkFlags.Compressed]
+        decompressed_data = batch.decompress_many((c.encoded_data for c in compressed_chunks), workers=workers,
+                                                  catch_errors=True)
+    else:
+        decompressed_data = None
+
+    sidecar_file = None
+    file_writer = None
+    try:
+        sidecar_file = open(sidecar_path, "wb") if sidecar_path else None
+        file_writer = ChunkDataFileWriter(jobs) if chunk_data_dir else None
+        for chunk in this_file.chunks:
+            if decompress and chunk.flags & model.ChunkFlags.Compressed:
+                chunk_decompressed_data = next(decompressed_data)
+                if isinstance(chunk_decompressed_data, codecs.CompressionException):
+                    logger.warning("%s: could not decompress chunk data, writing it compressed: %s",
+                                   chunk.chunk_id, chunk_decompressed_data)
+                    chunk_decompressed_data = None
+            else:
+                chunk_decompressed_data = None
+            _write_chunk_xml(output, chunk, file_writer, chunk_data_dir, sidecar_file, chunk_decompressed_data)
+    finally:
+        if decompressed_data is not None:
+            # Shut down the worker processes, even if writing the XML failed
+            decompressed_data.close()
+        if sidecar_file:
+            sidecar_file.close()
+        if file_writer:
+            file_writer.close()
+
+    output.write("</%s>\n" % chunky_root.tag)
+
+    logger.debug("Wrote XML for %d chunks in %.3fs", len(this_file.chunks), time.perf_counter() - start_time)
+    if file_writer:
+        logger.debug("Wrote %d chunk data files (0x%x bytes) with %d threads, waited %.3fs for writes to finish",
+                     file_writer.files_written, file_writer.bytes_written, file_writer.jobs, file_writer.wait_time)
+
+
+class ChunkDataFileWriter:
+    """ Writes chunk data files in a pool of threads, with a limited number of writes in flight """
+
+    def __init__(self, jobs=None):
+        """
+        :param jobs: number of threads. Defaults to the number of CPUs plus four, up to 32. If 1, files are written
+                     by the calling thread.
+        """
+        self.jobs = jobs or min(32, (os.cpu_count() or 1) + 4)
+        self.files_written = 0
+        self.bytes_written = 0
+        self.wait_time = 0.0
+        self._pool = ThreadPoolExecutor(max_workers=self.jobs) if self.jobs != 1 else None
+        self._pending = deque()
+
+    def write(self, path, data):
+        """ Write data to a file. Errors are raised by a later call to write or close. """
+        self.files_written += 1
+        self.bytes_written += len(data)
+        if self._pool is None:
+            _write_file(path, data)
+            return
+
+        self._pending.append(self._pool.submit(_write_file, path, data))
+        if len(self._pending) >= self.jobs * 4:
+            self._wait_for_oldest()
+
+    def _wait_for_oldest(self):
+        start_time = time.perf_counter()
+        try:
+            self._pending.popleft().result()
+        finally:
+            self.wait_time += time.perf_counter() - start_time
+
+    def close(self):
+        """ Wait for all writes to finish """
+        try:
+            while self._pending:
+                self._wait_for_oldest()
+        finally:
+            if self._pool:
+                self._pool.shutdown()
+
+
+def _write_file(path, data):
+    with open(path, "wb") as data_file:
+        data_file.write(data)
+
+
+def _write_chunk_xml(output, chunk, file_writer, chunk_data_dir, sidecar_file, decompressed_data):
+    """
+    Write the XML for one chunk, and write its data to a chunk data file or the sidecar file if needed
+    :param file_writer: ChunkDataFileWriter for chunk data files in chunk_data_dir
+    :param decompressed_data: if set, the decompressed data of a compressed chunk, to write instead of its raw data
+    """
+    chunk_element = ElementTree.Element("Chunk")
+    chunk_element.set("tag", chunk.chunk_id.tag)
+    chunk_element.set("number", str(chunk.chunk_id.number))
+    if chunk.name:
+        chunk_element.set("name", chunk.name)
+    if chunk.flags & model.ChunkFlags.Loner:
+        chunk_element.set("loner", "true")
+
+    # Add children
+    for chunk_child in chunk.children:
+        child_element = ElementTree.SubElement(chunk_element, "Child")
+        child_element.set("chid", str(chunk_child.chid))
+        child_element.set("tag", chunk_child.ref.tag)
+        child_element.set("number", str(chunk_child.ref.number))
+
+    # Add data
+    if decompressed_data is not None:
+        is_compressed = False
+        this_chunk_data = decompressed_data
+    elif chunk.flags & model.ChunkFlags.Compressed:
+        is_compressed = True
+        this_chunk_data = chunk.encoded_data
+        chunk_element.set("compressed", "true")
+    else:
+        is_compressed = False
+        this_chunk_data = chunk.raw_data
+
+    if chunk_data_dir:
+        file_extension = chunk.chunk_id.tag.lower().rstrip(" ")
 
-    this_file_xml = ElementTree.tostring(chunky_root)
-    # Pretty-print the XML
-    dom = minidom.parseString(this_file_xml)
-    this_file_pretty_xml = dom.toprettyxml()
+        # HACK
+        if file_extension == "wave":
+            file_extension = "wav"
+        chunk_data_file_name = "%d.%s" % (chunk.chunk_id.number, file_extension)
 
-    return this_file_pretty_xml
+        if is_compressed:
+            compression_type = codecs.identify_compression(this_chunk_data).name
+            chunk_data_file_name += ".%s" % (compression_type.lower())
+
+        chunk_data_file_path = chunk_data_dir / chunk_data_file_name
+        file_writer.write(chunk_data_file_path, this_chunk_data)
+
+        # Create element for data
+        data_element = ElementTree.SubElement(chunk_element, "File")
+        data_element.text = str(chunk_data_file_path)
+        if is_compressed:
+            data_element.set("compressed", "true")
+    elif sidecar_file:
+        # Pack the data into the sidecar file
+        data_element = ElementTree.SubElement(chunk_element, "Blob")
+        data_element.set("offset", str(sidecar_file.tell()))
+        data_element.set("size", str(len(this_chunk_data)))
+        sidecar_file.write(this_chunk_data)
+    else:
+        data_element = ElementTree.SubElement(chunk_element, "Data")
+        data_element.text = base64.b64encode(this_chunk_data).decode("utf-8")
+
+    # Write the chunk and let it go before moving on to the next chunk
+    _write_element(output, chunk_element, 1)
+
+
+def _escape(value):
+    """ Escape text or an attribute value """
+    return value.replace("&", "&amp;").replace("<", "&lt;").replace("\"", "&quot;").replace(">", "&gt;")
+
+
+def _format_attributes(element):
+    return "".join(' %s="%s"' % (name, _escape(value)) for name, value in element.items())
+
+
+def _write_element(output, element, depth):
+    """ Write an element and its children to a text file, indented with tabs """
+    indent = "\t" * depth
+    attributes = _format_attributes(element)
+    if element.text:
+        output.write("%s<%s%s>%s</%s>\n" % (indent, element.tag, attributes, _escape(element.text), element.tag))
+    elif len(element) > 0:
+        output.write("%s<%s%s>\n" % (indent, element.tag, attributes))
+        for child in element:
+            _write_element(output, child, depth + 1)
+        output.write("%s</%s>\n" % (indent, element.tag))
+    else:
+        output.write("%s<%s%s/>\n" % (indent, element.tag, attributes))
 
 
 def xml_to_chunky_file(chunky_file, xml_path, change_file_type=False):
     """
-    Load chunks from an XML file and add them to a chunky file
+    Load chunks from an XML file and add them to a chunky file. Chunks are added as they are parsed, so only one
+    chunk element is held in memory at a time. If the chunk data is packed into a sidecar file, the sidecar file is
+    memory mapped and the chunk data refers to the mapped memory without copying it.
     :param chunky_file: Existing chunky file instance that new chunks will be added to
     :param xml_path: XML filename
     :param change_file_type: change the file type tag in the header
     """
     logger = logging.getLogger(__name__)
 
-    # Load XML file
-    tree = ElementTree.parse(xml_path)
-    chunky_file_xml = tree.getroot()
+    chunky_file_xml = None
+    sidecar_data = None
+    depth = 0
+    for event, element in ElementTree.iterparse(xml_path, events=("start", "end")):
+        if event == "start":
+            depth += 1
+            if depth == 1:
+                chunky_file_xml = element
+                _set_file_options(chunky_file, chunky_file_xml, change_file_type, logger)
+                sidecar_path = chunky_file_xml.attrib.get("sidecar")
+                if sidecar_path:
+                    sidecar_data = _map_sidecar(chunky_file, _resolve_sidecar_path(xml_path, sidecar_path))
+            continue
+
+        depth -= 1
+        if depth == 1:
+            if element.tag == "Chunk":
+                _add_chunk_from_xml(chunky_file, element, logger, sidecar_data)
+            # Drop the element and its data now that it has been processed
+            chunky_file_xml.clear()
+
+
+def _make_sidecar_reference(output, sidecar_path):
+    """ Get the sidecar path to store in the XML: relative to the XML file if it is on disk, otherwise absolute """
+    sidecar_path = os.path.abspath(sidecar_path)
+    output_path = getattr(output, "name", None)
+    if isinstance(output_path, str):
+        try:
+            return os.path.relpath(sidecar_path, os.path.dirname(os.path.abspath(output_path)))
+        except ValueError:
+            # On a different drive
+            pass
+    return sidecar_path
+
+
+def _resolve_sidecar_path(xml_path, sidecar_path):
+    """ Sidecar paths that are not absolute are relative to the XML file """
+    sidecar_path = pathlib.Path(sidecar_path)
+    if not sidecar_path.is_absolute() and isinstance(xml_path, (str, os.PathLike)):
+        sidecar_path = pathlib.Path(xml_path).parent / sidecar_path
+    return sidecar_path
+
 
+def _map_sidecar(chunky_file, sidecar_path):
+    """
+    Map a sidecar file into memory. The mapping is closed when the chunky file is closed.
+    :return: memoryview of the sidecar file
+    """
+    with open(sidecar_path, "rb") as sidecar_file:
+        if os.fstat(sidecar_file.fileno()).st_size == 0:
+            # Empty files can't be mapped
+            return memoryview(b'')
+        mapping = mmap.mmap(sidecar_file.fileno(), 0, access=mmap.ACCESS_READ)
+    chunky_file.add_backing(mapping)
+    return memoryview(mapping)
+
+
+def _set_file_options(chunky_file, chunky_file_xml, change_file_type, logger):
+    """ Set chunky file options from the root element of an XML file """
     # TODO: validate with an XSD?
     if chunky_file_xml.tag != "ChunkyFile":
         raise Exception("Not the right kind of XML file")
@@ -122,67 +342,80 @@ def xml_to_chunky_file(chunky_file, xml_path, change_file_type=False):
             logger.warning("Changing file character set from %s to %s", chunky_file.characterset, charset)
             chunky_file.characterset = charset
 
-    for chunk_xml in chunky_file_xml.findall("Chunk"):
-        # Get chunk metadata
-        chunk_tag = chunk_xml.attrib["tag"]
-        chunk_number = int(chunk_xml.attrib["number"])
-        chunk_id = model.ChunkId(chunk_tag, chunk_number)
-        chunk_name = chunk_xml.attrib.get("name", None)
-        logger.debug("Processing chunk: %s - %s", chunk_id, chunk_name if chunk_name else "n/a")
-        chunk_flags = model.ChunkFlags.Default
-        if chunk_xml.attrib.get("loner", "false").lower() == "true":
-            chunk_flags |= model.ChunkFlags.Loner
-        if chunk_xml.attrib.get("compressed", "false").lower() == "true":
-            chunk_flags |= model.ChunkFlags.Compressed
-
-        # Get chunk children and data
-        chunk_data = None
-        chunk_children = list()
-        for child_xml in chunk_xml:
-            if child_xml.tag == "Child":
-                chid = int(child_xml.attrib["chid"])
-                tag = child_xml.attrib["tag"]
-                number = int(child_xml.attrib["number"])
-
-                chunk_child = model.ChunkChild(chid=chid, ref=model.ChunkId(tag, number))
-                chunk_children.append(chunk_child)
-
-            elif child_xml.tag == "Data":
-                chunk_data = base64.b64decode(child_xml.text)
-            elif child_xml.tag == "File":
-                with open(child_xml.text, "rb") as data_file:
-                    chunk_data = data_file.read()
-            else:
-                raise Exception("unhandled child tag type: %s" % child_xml.tag)
-
-        # Check if there is an existing chunk
-        if chunk_id in chunky_file:
-            existing_chunk = chunky_file[chunk_id]
-            logger.info("%s: Modifying existing chunk", chunk_id)
-
-            # Update chunk metadata
-            if chunk_name:
-                existing_chunk.name = chunk_name
-            if chunk_flags != existing_chunk.flags:
-                # TODO: set flags correctly
-                # if the loner flag is not set correctly the file won't load
-                logger.warning("Chunk flags are different: %s vs %s", existing_chunk.flags, chunk_flags)
-
-            # TODO: update existing children instead of just adding
-            for new_child in chunk_children:
-                existing_child = [c for c in existing_chunk.children if c.chid == new_child.chid]
-                if len(existing_child) > 0:
-                    logger.warning("child %s: %s already exists" % (existing_chunk, existing_child))
-                else:
-                    existing_chunk.children.append(new_child)
-
-            # Set chunk data
-            # TODO: handle compression
-            if chunk_data:
-                existing_chunk.raw_data = chunk_data
+
+def _add_chunk_from_xml(chunky_file, chunk_xml, logger, sidecar_data=None):
+    """
+    Add a chunk from a Chunk element to a chunky file, or update the existing chunk
+    :param sidecar_data: memoryview of the sidecar file, if the XML has one
+    """
+    # Get chunk metadata
+    chunk_tag = chunk_xml.attrib["tag"]
+    chunk_number = int(chunk_xml.attrib["number"])
+    chunk_id = model.ChunkId(chunk_tag, chunk_number)
+    chunk_name = chunk_xml.attrib.get("name", None)
+    logger.debug("Processing chunk: %s - %s", chunk_id, chunk_name if chunk_name else "n/a")
+    chunk_flags = model.ChunkFlags.Default
+    if chunk_xml.attrib.get("loner", "false").lower() == "true":
+        chunk_flags |= model.ChunkFlags.Loner
+    if chunk_xml.attrib.get("compressed", "false").lower() == "true":
+        chunk_flags |= model.ChunkFlags.Compressed
+
+    # Get chunk children and data
+    chunk_data = None
+    chunk_children = list()
+    for child_xml in chunk_xml:
+        if child_xml.tag == "Child":
+            chid = int(child_xml.attrib["chid"])
+            tag = child_xml.attrib["tag"]
+            number = int(child_xml.attrib["number"])
+
+            chunk_child = model.ChunkChild(chid=chid, ref=model.ChunkId(tag, number))
+            chunk_children.append(chunk_child)
+
+        elif child_xml.tag == "Data":
+            chunk_data = base64.b64decode(child_xml.text)
+        elif child_xml.tag == "File":
+            with open(child_xml.text, "rb") as data_file:
+                chunk_data = data_file.read()
+        elif child_xml.tag == "Blob":
+            if sidecar_data is None:
+                raise Exception("%s: chunk data is in a sidecar file, but there is no sidecar file" % (chunk_id,))
+            offset = int(child_xml.attrib["offset"])
+            size = int(child_xml.attrib["size"])
+            if offset < 0 or size < 0 or offset + size > len(sidecar_data):
+                raise Exception("%s: chunk data is outside of the sidecar file" % (chunk_id,))
+            chunk_data = sidecar_data[offset:offset + size]
         else:
-            logger.info("%s: Creating new chunk", chunk_id)
-            # Create a new chunk
-            this_chunk = model.Chunk(chunk_tag, chunk_number, chunk_name, chunk_flags, data=chunk_data)
-            this_chunk.children = chunk_children
-            chunky_file.chunks.append(this_chunk)
+            raise Exception("unhandled child tag type: %s" % child_xml.tag)
+
+    # Check if there is an existing chunk
+    if chunk_id in chunky_file:
+        existing_chunk = chunky_file[chunk_id]
+        logger.info("%s: Modifying existing chunk", chunk_id)
+
+        # Update chunk metadata
+        if chunk_name:
+            existing_chunk.name = chunk_name
+        if chunk_flags != existing_chunk.flags:
+            # TODO: set flags correctly
+            # if the loner flag is not set correctly the file won't load
+            logger.warning("Chunk flags are different: %s vs %s", existing_chunk.flags, chunk_flags)
+
+        # TODO: update existing children instead of just adding
+        for new_child in chunk_children:
+            existing_child = [c for c in existing_chunk.children if c.chid == new_child.chid]
+            if len(existing_child) > 0:
+                logger.warning("child %s: %s already exists" % (existing_chunk, existing_child))
+            else:
+                chunky_file.add_child(chunk_id, new_child)
+
+        # Set chunk data. Unchanged data is left alone so that the chunk isn't marked as modified.
+        # TODO: handle compression
+        if chunk_data and chunk_data != existing_chunk.raw_data:
+            existing_chunk.raw_data = chunk_data
+    else:
+        logger.info("%s: Creating new chunk", chunk_id)
+        # Create a new chunk
+        this_chunk = model.Chunk(chunk_tag, chunk_number, chunk_name, chunk_flags, data=chunk_data)
+        this_chunk.children = chunk_children
+        chunky_file.add_chunk(this_chunk)
@@ -1,4 +1,5 @@
 import enum
+import struct
 
 
 class CompressionType(enum.IntEnum):
@@ -8,6 +9,44 @@ class CompressionType(enum.IntEnum):
     KCD2 = 2
 
 
+class CompressionException(Exception):
+    """ Raised if compressed data is corrupt or uses an unsupported format. """
+    pass
+
+
+# Compressed data starts with a header: four byte magic, then the decompressed size as a big-endian 32-bit number,
+# then a flags byte that is always zero. The bit stream follows.
+COMPRESSION_HEADER = struct.Struct(">4sIB")
+COMPRESSION_HEADER_SIZE = COMPRESSION_HEADER.size
+
+# The bit stream is padded with 0xFF bytes so the decoder can read ahead without running off the end
+COMPRESSION_TAIL = b'\xff' * 6
+
+# Back-references are encoded with a prefix that selects how many bits are used for the offset:
+# (prefix value, prefix size, offset bits, smallest offset)
+KCDC_OFFSET_CLASSES = [
+    (0b01, 2, 6, 0x1),  # 10
+    (0b011, 3, 9, 0x41),  # 110
+    (0b0111, 4, 12, 0x241),  # 1110
+    (0b1111, 4, 20, 0x1241),  # 1111
+]
+
+# An offset in the largest class with all bits set marks the end of the stream
+KCDC_END_OF_STREAM = 0xFFFFF
+
+# Longest length that can be encoded
+KCDC_MAX_LENGTH_BITS = 24
+
+# The cheapest back-reference is a 2 bit prefix, 6 offset bits and a length with n bits after n + 1 prefix bits. It
+# costs 9 + 2 * n bits and copies up to 2 ** (n + 1) + 1 bytes, which is the most output that any token can produce
+# for its size. This limits the size that a bit stream can decompress to.
+KCDC_MIN_MATCH_BITS = 9
+
+# The decoder's bit buffer always holds at least one complete token. It is refilled this many bytes at a time.
+MIN_BUFFERED_BITS = 96
+REFILL_SIZE = 16
+
+
 def identify_compression(data):
     if data[0:4] == b'KCDC':
         return CompressionType.KCDC
@@ -15,3 +54,432 @@ def identify_compression(data):
         return CompressionType.KCD2
     else:
         return CompressionType.Uncompressed
+
+
+def parse_compression_header(data):
+    """
+    Parse the header of a compressed chunk
+    :param data: compressed chunk data
+    :return: tuple of compression type and decompressed size
+    """
+    if len(data) < COMPRESSION_HEADER_SIZE:
+        raise CompressionException("Compression header truncated")
+
+    magic, decompressed_size, flags = COMPRESSION_HEADER.unpack_from(data)
+    compression_type = identify_compression(magic)
+    if compression_type == CompressionType.Uncompressed:
+        raise CompressionException("Unknown compression type: %s" % magic)
+    if flags != 0:
+        raise CompressionException("Unsupported compression flags: 0x%x" % flags)
+
+    return compression_type, decompressed_size
+
+
+def decompress(data, output=None):
+    """
+    Decompress chunk data
+    :param data: compressed chunk data, starting with a compression header
+    :param output: optional, writable buffer to decompress into. Must be at least as big as the decompressed data.
+    :return: buffer containing the decompressed data. If output was given, this is a view of it.
+    """
+    compression_type, _ = parse_compression_header(data)
+    if compression_type == CompressionType.KCDC:
+        return decompress_kcdc(data, output)
+    else:
+        return decompress_kcd2(data, output)
+
+
+def max_decompressed_size(stream_size):
+    """
+    Get the most data that a KCDC or KCD2 bit stream can decompress to
+    :param stream_size: size of the bit stream in bytes, not including the compression header
+    :return: maximum decompressed size in bytes
+    """
+    stream_bits = 8 * max(stream_size, 0)
+    longest_match_bits = KCDC_MIN_MATCH_BITS + 2 * KCDC_MAX_LENGTH_BITS
+    if stream_bits < longest_match_bits:
+        # Room for one match, at most
+        length_bits = max(stream_bits - KCDC_MIN_MATCH_BITS, 0) // 2
+        return (1 << (length_bits + 1)) + 1
+
+    # Every match is as long as possible
+    return (stream_bits // longest_match_bits + 1) * ((1 << (KCDC_MAX_LENGTH_BITS + 1)) + 1)
+
+
+def _prepare_output(output, decompressed_size):
+    """ Allocate or check the buffer that data is decompressed into """
+    if output is None:
+        return bytearray(decompressed_size)
+
+    output = memoryview(output).cast("B")
+    if output.readonly:
+        raise ValueError("Output buffer is read-only")
+    if len(output) < decompressed_size:
+        raise ValueError("Output buffer too small: need 0x%x bytes, got 0x%x" % (decompressed_size, len(output)))
+    return output[0:decompressed_size]
+
+
+def _copy_match(out, out_pos, offset, length):
+    """ Copy a back-reference. The source may overlap the destination, which repeats the last offset bytes. """
+    src_pos = out_pos - offset
+    if offset >= length:
+        out[out_pos:out_pos + length] = out[src_pos:src_pos + length]
+    else:
+        pattern = bytes(out[src_pos:out_pos])
+        out[out_pos:out_pos + length] = (pattern * (length // offset + 1))[0:length]
+
+
+def decompress_kcdc(data, output=None):
+    """
+    Decompress KCDC data.
+
+    The bit stream is read from the least significant bit of each byte. Each token is one of:
+        0 <8 bits>                  literal byte
+        1 <offset> <length>         copy length bytes from offset bytes back in the output
+    The offset starts with a prefix that selects its size (see KCDC_OFFSET_CLASSES). The length is a count of 1 bits,
+    a 0 bit, then that many bits of value: length = 2^count + value + 1. Copies with a 20-bit offset are one byte
+    longer.
+
+    :param data: compressed chunk data, starting with a compression header
+    :param output: optional, writable buffer to decompress into
+    :return: buffer containing the decompressed data
+    """
+    return _decompress(data, output, CompressionType.KCDC)
+
+
+def decompress_kcd2(data, output=None):
+    """
+    Decompress KCD2 data.
+
+    KCD2 uses the same bit stream as KCDC, except that literals are stored in runs:
+        0 <length> <length * 8 bits>    run of literal bytes
+        1 <offset> <length>             copy length bytes from offset bytes back in the output
+    The length of a literal run is encoded like a KCDC length, but starts at one: length = 2^count + value.
+
+    :param data: compressed chunk data, starting with a compression header
+    :param output: optional, writable buffer to decompress into, such as a memoryview of a larger buffer
+    :return: buffer containing the decompressed data
+    """
+    return _decompress(data, output, CompressionType.KCD2)
+
+
+def _decompress(data, output, expected_compression_type):
+    """ Decode a KCDC or KCD2 bit stream """
+    compression_type, decompressed_size = parse_compression_header(data)
+    if compression_type != expected_compression_type:
+        raise CompressionException("Not %s data" % expected_compression_type.name)
+    literal_runs = compression_type == CompressionType.KCD2
+    name = compression_type.name
+
+    # Don't allocate the output for a size that the data can't possibly decompress to, eg. from a corrupt header
+    max_size = max_decompressed_size(len(data) - COMPRESSION_HEADER_SIZE)
+    if decompressed_size > max_size:
+        raise CompressionException("%s decompressed size 0x%x is too big for 0x%x bytes of data" % (
+            name, decompressed_size, len(data)))
+
+    out = _prepare_output(output, decompressed_size)
+    data = memoryview(data).cast("B")
+    data_pos = COMPRESSION_HEADER_SIZE
+    out_pos = 0
+
+    bits = 0
+    bit_count = 0
+    from_bytes = int.from_bytes
+
+    try:
+        while True:
+            # Refill the bit buffer. Past the end of the data, zeros are shifted in until the buffer underflows.
+            if bit_count < MIN_BUFFERED_BITS:
+                if bit_count < 0:
+                    raise CompressionException("%s data truncated" % name)
+                refill = data[data_pos:data_pos + REFILL_SIZE]
+                bits |= from_bytes(refill, "little") << bit_count
+                bit_count += 8 * len(refill)
+                data_pos += REFILL_SIZE
+
+            if not bits & 1:
+                if not literal_runs:
+                    # Literal byte
+                    out[out_pos] = (bits >> 1) & 0xFF
+                    out_pos += 1
+                    bits >>= 9
+                    bit_count -= 9
+                    continue
+
+                # Run of literal bytes: decode the length, then copy the bytes straight out of the bit buffer
+                bits >>= 1
+                length_bits = (~bits & (bits + 1)).bit_length() - 1
+                if length_bits > KCDC_MAX_LENGTH_BITS:
+                    raise CompressionException("%s length too long" % name)
+                bits >>= length_bits + 1
+                length = (1 << length_bits) + (bits & ((1 << length_bits) - 1))
+                bits >>= length_bits
+                bit_count -= 2 * length_bits + 2
+                if bit_count < 0:
+                    # The length was decoded from the zeros shifted in past the end of the data
+                    raise CompressionException("%s data truncated" % name)
+
+                run_bits = 8 * length
+                if bit_count < run_bits:
+                    refill = data[data_pos:data_pos + length + REFILL_SIZE]
+                    bits |= from_bytes(refill, "little") << bit_count
+                    bit_count += 8 * len(refill)
+                    data_pos += length + REFILL_SIZE
+                    if bit_count < run_bits:
+                        raise CompressionException("%s data truncated" % name)
+
+                if out_pos + length > decompressed_size:
+                    raise CompressionException("%s data overflows the output buffer" % name)
+                out[out_pos:out_pos + length] = (bits & ((1 << run_bits) - 1)).to_bytes(length, "little")
+                out_pos += length
+                bits >>= run_bits
+                bit_count -= run_bits
+                continue
+
+            # Back-reference: decode the offset
+            if not bits & 2:
+                offset = ((bits >> 2) & 0x3F) + 0x1
+                bits >>= 8
+                bit_count -= 8
+                extra_length = 1
+            elif not bits & 4:
+                offset = ((bits >> 3) & 0x1FF) + 0x41
+                bits >>= 12
+                bit_count -= 12
+                extra_length = 1
+            elif not bits & 8:
+                offset = ((bits >> 4) & 0xFFF) + 0x241
+                bits >>= 16
+                bit_count -= 16
+                extra_length = 1
+            else:
+                offset_bits = (bits >> 4) & 0xFFFFF
+                bits >>= 24
+                bit_count -= 24
+                if offset_bits == KCDC_END_OF_STREAM:
+                    if bit_count < 0:
+                        raise CompressionException("%s data truncated" % name)
+                    break
+                offset = offset_bits + 0x1241
+                extra_length = 2
+
+            # Decode the length: count the 1 bits before the first 0 bit
+            length_bits = (~bits & (bits + 1)).bit_length() - 1
+            if length_bits > KCDC_MAX_LENGTH_BITS:
+                raise CompressionException("%s length too long" % name)
+            bits >>= length_bits + 1
+            length = (1 << length_bits) + (bits & ((1 << length_bits) - 1)) + extra_length
+            bits >>= length_bits
+            bit_count -= 2 * length_bits + 1
+
+            if offset > out_pos:
+                raise CompressionException("%s offset points before the start of the data" % name)
+            if out_pos + length > decompressed_size:
+                raise CompressionException("%s data overflows the output buffer" % name)
+            _copy_match(out, out_pos, offset, length)
+            out_pos += length
+    except IndexError:
+        raise CompressionException("%s data overflows the output buffer" % name)
+
+    if out_pos != decompressed_size:
+        raise CompressionException("%s data decompressed to 0x%x bytes, expected 0x%x" % (
+            name, out_pos, decompressed_size))
+
+    return out
+
+
+class BitWriter:
+    """ Writes a bit stream, starting from the least significant bit of each byte """
+
+    def __init__(self):
+        self.data = bytearray()
+        self._bits = 0
+        self._bit_count = 0
+
+    def write(self, value, number_of_bits):
+        """ Write the low number_of_bits bits of value """
+        self._bits |= (value & ((1 << number_of_bits) - 1)) << self._bit_count
+        self._bit_count += number_of_bits
+        if self._bit_count >= 64:
+            # Move all of the complete bytes into the output
+            number_of_bytes = self._bit_count // 8
+            self.data += (self._bits & ((1 << (8 * number_of_bytes)) - 1)).to_bytes(number_of_bytes, "little")
+            self._bits >>= 8 * number_of_bytes
+            self._bit_count -= 8 * number_of_bytes
+
+    def flush(self):
+        """ Write any remaining bits, padding the last byte with zeros. Returns the bit stream. """
+        number_of_bytes = (self._bit_count + 7) // 8
+        self.data += self._bits.to_bytes(number_of_bytes, "little")
+        self._bits = 0
+        self._bit_count = 0
+        return self.data
+
+
+class CompressionLevel(enum.IntEnum):
+    """ Trade-off between compression speed and size """
+    Fast = 1
+    Default = 2
+    Max = 3
+
+
+# Match finder settings for each level:
+# (number of earlier positions to try per hash chain, add every position inside a match to the hash chains,
+#  check whether the next position has a longer match before taking a match)
+COMPRESSION_LEVEL_SETTINGS = {
+    CompressionLevel.Fast: (4, False, False),
+    CompressionLevel.Default: (32, True, False),
+    CompressionLevel.Max: (256, True, True),
+}
+
+# Shortest match found by the match finder
+MIN_MATCH_LENGTH = 3
+# Longest match or literal run the encoder emits (a length with at most 11 bits of value)
+MAX_MATCH_LENGTH = 0x1000
+MAX_LITERAL_RUN = 0xFFF
+# Largest offset that can be encoded: the largest 20-bit offset is the end of stream marker
+MAX_OFFSET = 0x1241 + KCDC_END_OF_STREAM - 1
+
+
+def _write_length(bit_writer, length):
+    """ Write a length as a count of 1 bits, a 0 bit and the bits of the value after its top bit """
+    length_bits = length.bit_length() - 1
+    bit_writer.write((1 << length_bits) - 1, length_bits + 1)
+    bit_writer.write(length, length_bits)
+
+
+def _write_match(bit_writer, offset, length):
+    """ Write a back-reference """
+    for prefix, prefix_size, offset_bits, min_offset in reversed(KCDC_OFFSET_CLASSES):
+        if offset >= min_offset:
+            bit_writer.write(prefix, prefix_size)
+            bit_writer.write(offset - min_offset, offset_bits)
+            _write_length(bit_writer, length - (2 if min_offset == 0x1241 else 1))
+            return
+
+
+def _write_literals(bit_writer, data, start, end, literal_runs):
+    """ Write the bytes data[start:end] as literals """
+    if not literal_runs:
+        for b in data[start:end]:
+            bit_writer.write(b << 1, 9)
+        return
+
+    for run_start in range(start, end, MAX_LITERAL_RUN):
+        run = data[run_start:min(end, run_start + MAX_LITERAL_RUN)]
+        bit_writer.write(0, 1)
+        _write_length(bit_writer, len(run))
+        bit_writer.write(int.from_bytes(run, "little"), 8 * len(run))
+
+
+def _match_length(data, a, b, max_length):
+    """ Get the number of bytes that match at positions a and b, comparing a block at a time """
+    length = 0
+    while length + 32 <= max_length and data[a + length:a + length + 32] == data[b + length:b + length + 32]:
+        length += 32
+    while length < max_length and data[a + length] == data[b + length]:
+        length += 1
+    return length
+
+
+def _find_match(data, pos, head, prev, max_chain):
+    """
+    Find the longest earlier match for the data at pos using the hash chains
+    :return: tuple of (offset, length). Length is 0 if there is no match.
+    """
+    max_length = min(MAX_MATCH_LENGTH, len(data) - pos)
+    best_offset = 0
+    best_length = 0
+    if max_length < MIN_MATCH_LENGTH:
+        return best_offset, best_length
+
+    candidate = head.get((data[pos] << 16) | (data[pos + 1] << 8) | data[pos + 2], -1)
+    chain = max_chain
+    while candidate >= 0 and chain > 0:
+        offset = pos - candidate
+        if offset > MAX_OFFSET:
+            break
+
+        # Only compare the whole match if it can beat the best one so far
+        if data[candidate + best_length] == data[pos + best_length] if best_length < max_length else False:
+            length = _match_length(data, candidate, pos, max_length)
+            # Matches with a 20-bit offset must be at least one byte longer
+            if length > best_length and (offset < 0x1241 or length > MIN_MATCH_LENGTH):
+                best_offset, best_length = offset, length
+                if length == max_length:
+                    break
+
+        candidate = prev[candidate]
+        chain -= 1
+
+    return best_offset, best_length
+
+
+def compress(data, compression_type=CompressionType.KCDC, level=CompressionLevel.Default):
+    """
+    Compress chunk data
+    :param data: data to compress
+    :param compression_type: KCDC or KCD2
+    :param level: CompressionLevel
+    :return: compressed data, starting with a compression header
+    """
+    if compression_type not in (CompressionType.KCDC, CompressionType.KCD2):
+        raise ValueError("Unsupported compression type: %s" % compression_type)
+    literal_runs = compression_type == CompressionType.KCD2
+    max_chain, insert_all, lazy = COMPRESSION_LEVEL_SETTINGS[CompressionLevel(level)]
+
+    data = bytes(data)
+    data_size = len(data)
+    bit_writer = BitWriter()
+
+    # Hash chains of earlier positions for each three byte sequence: head has the latest position for each hash,
+    # and prev links each position to the previous position with the same hash.
+    head = {}
+    prev = [-1] * data_size
+
+    def insert(insert_pos):
+        if insert_pos + MIN_MATCH_LENGTH <= data_size:
+            key = (data[insert_pos] << 16) | (data[insert_pos + 1] << 8) | data[insert_pos + 2]
+            prev[insert_pos] = head.get(key, -1)
+            head[key] = insert_pos
+
+    pos = 0
+    literal_start = 0
+    while pos < data_size:
+        offset, length = _find_match(data, pos, head, prev, max_chain)
+
+        if length and lazy and pos + 1 < data_size:
+            # Emit a literal instead if the next position has a longer match
+            insert(pos)
+            next_offset, next_length = _find_match(data, pos + 1, head, prev, max_chain)
+            if next_length > length:
+                pos += 1
+                continue
+            inserted = pos + 1
+        else:
+            inserted = pos
+
+        if not length:
+            insert(pos)
+            pos += 1
+            continue
+
+        _write_literals(bit_writer, data, literal_start, pos, literal_runs)
+        _write_match(bit_writer, offset, length)
+
+        if insert_all:
+            for insert_pos in range(inserted, pos + length):
+                insert(insert_pos)
+        elif inserted == pos:
+            insert(pos)
+        pos += length
+        literal_start = pos
+
+    _write_literals(bit_writer, data, literal_start, data_size, literal_runs)
+
+    # End of stream
+    bit_writer.write(0b1111, 4)
+    bit_writer.write(KCDC_END_OF_STREAM, 20)
+
+    header = COMPRESSION_HEADER.pack(compression_type.name.encode("ascii"), data_size, 0)
+    return header + bit_writer.flush() + COMPRESSION_TAIL
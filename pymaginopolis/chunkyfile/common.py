@@ -1,4 +1,5 @@
 import struct
+from functools import lru_cache
 
 from pymaginopolis.chunkyfile import model as model
 from pymaginopolis.chunkyfile.model import Endianness, CharacterSet
@@ -47,7 +48,7 @@ def parse_pascal_string(characterset, data):
 
     string_size = struct.unpack("<" + string_size_format, data[0:string_size_size])[0] * character_size
     string_data = data[string_size_size:string_size_size + string_size]
-    result = string_data.decode(CHARACTER_SETS[characterset])
+    result = bytes(string_data).decode(CHARACTER_SETS[characterset])
 
     total_size = string_size_size + string_size
     return result, total_size
@@ -83,6 +84,7 @@ def parse_endianness_and_characterset(data):
     return endianness, characterset,
 
 
+@lru_cache(256)
 def tag_bytes_to_string(tag):
     """
     Convert the raw bytes for a tag into a string
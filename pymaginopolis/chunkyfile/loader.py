@@ -1,9 +1,10 @@
 import logging
+import mmap as mmapfile
 import struct
 
 import pymaginopolis.chunkyfile.model as model
+from pymaginopolis.chunkyfile.chunktable import ChunkTable
 from pymaginopolis.chunkyfile.common import parse_pascal_string_with_encoding, FileParseException, check_size, \
-    parse_u24le, \
     parse_endianness_and_characterset, tag_bytes_to_string, CHARACTER_SETS
 
 # Structure sizes
@@ -11,6 +12,24 @@ FILE_HEADER_SIZE = 0x24
 INDEX_HEADER_SIZE = 0x14
 CHUNK_ATTRIBUTES_HEADER_SIZE = 0x14
 CHUNK_CHILD_SIZE = 0xc
+INDEX_ENTRY_SIZE = 8
+
+# Number of index entries to read at a time when streaming chunk headers
+INDEX_ENTRY_BATCH_SIZE = 0x400
+
+# Chunks closer together than this are read from the file in one read
+DEFAULT_MAX_READ_GAP = 0x1000
+# Nearby chunks are not merged into reads larger than this
+DEFAULT_MAX_READ_SIZE = 0x100000
+
+# Precompiled structures
+# The chunk flags are packed into the low byte of the 32-bit field that holds the 24-bit data size
+CHUNK_ATTRIBUTES_HEADER = struct.Struct("<4sIIIHH")
+CHUNK_CHILD = struct.Struct("<4s2I")
+INDEX_ENTRY = struct.Struct("<2I")
+# Same structures with tags left as 32-bit integers
+CHUNK_ATTRIBUTES_HEADER_RAW = struct.Struct("<IIIIHH")
+CHUNK_CHILD_RAW = struct.Struct("<3I")
 
 LOGGER = logging.getLogger(__name__)
 
@@ -87,16 +106,16 @@ def parse_chunk_attributes(data):
     """
     check_size(CHUNK_ATTRIBUTES_HEADER_SIZE, len(data), "Chunk attributes")
 
-    chunk_attributes = struct.unpack("<4sIIB3sHH", data[0:CHUNK_ATTRIBUTES_HEADER_SIZE])
-    tag, number, offset, flags, size_packed, number_of_children, number_of_parents = chunk_attributes
+    chunk_attributes = CHUNK_ATTRIBUTES_HEADER.unpack_from(data)
+    tag, number, offset, flags_and_size, number_of_children, number_of_parents = chunk_attributes
 
     result = {
         # Tags are four byte little-endian ASCII strings
         "tag": tag_bytes_to_string(tag),
         "number": number,
         "offset": offset,
-        "flags": model.ChunkFlags(flags),
-        "size": parse_u24le(size_packed),  # This is a 24-bit number
+        "flags": model.ChunkFlags(flags_and_size & 0xFF),
+        "size": flags_and_size >> 8,  # This is a 24-bit number
         "children": number_of_children,
         "parents": number_of_parents,
     }
@@ -105,18 +124,12 @@ def parse_chunk_attributes(data):
     pos = CHUNK_ATTRIBUTES_HEADER_SIZE
     children = []
     if number_of_children > 0:
-        # TODO: validate enough bytes for the chunk attributes header
-
         expected_size = number_of_children * CHUNK_CHILD_SIZE
         check_size(expected_size, len(data) - pos, "Chunk attributes list")
 
-        for r in range(0, number_of_children):
-            child_data = data[pos:pos + CHUNK_CHILD_SIZE]
-            tag, number, child_id = struct.unpack("<4s2I", child_data)
-            tag = tag_bytes_to_string(tag)
-
-            children.append({"tag": tag, "number": number, "chid": child_id})
-            pos += CHUNK_CHILD_SIZE
+        children = [{"tag": tag_bytes_to_string(tag), "number": number, "chid": child_id}
+                    for tag, number, child_id in CHUNK_CHILD.iter_unpack(data[pos:pos + expected_size])]
+        pos += expected_size
 
     result["children"] = children
 
@@ -128,53 +141,242 @@ def parse_chunk_attributes(data):
     return result
 
 
-def read_index(file, index_offset):
-    # Read the index header
+class FileDataSource:
+    """ Reads chunk data from a file object """
+
+    def __init__(self, file):
+        self.file = file
+
+    def read(self, offset, size):
+        self.file.seek(offset)
+        return self.file.read(size)
+
+
+class ViewDataSource:
+    """ Slices chunk data from a memoryview of the whole file without copying it """
+
+    def __init__(self, view):
+        self.view = view
+
+    def read(self, offset, size):
+        return self.view[offset:offset + size]
+
+    def release(self):
+        """ Release the view so that the memory behind it can be closed """
+        self.view.release()
+
+
+def plan_reads(ranges, max_gap=DEFAULT_MAX_READ_GAP, max_read_size=DEFAULT_MAX_READ_SIZE):
+    """
+    Merge byte ranges into as few sequential reads as possible
+    :param ranges: iterable of (offset, size) tuples
+    :param max_gap: maximum number of unused bytes between two ranges for them to be merged into one read
+    :param max_read_size: ranges are not merged if the read would be larger than this
+    :return: list of (offset, size) tuples to read, sorted by offset
+    """
+    reads = []
+    for offset, size in sorted(ranges):
+        if reads:
+            read_offset, read_size = reads[-1]
+            read_end = read_offset + read_size
+            merged_end = max(read_end, offset + size)
+            if offset - read_end <= max_gap and merged_end - read_offset <= max_read_size:
+                reads[-1] = (read_offset, merged_end - read_offset)
+                continue
+        reads.append((offset, size))
+    return reads
+
+
+def read_chunk_data(file, chunk_locations, max_gap=DEFAULT_MAX_READ_GAP, max_read_size=DEFAULT_MAX_READ_SIZE):
+    """
+    Read the data for a set of chunks in ascending file offset order, merging nearby chunks into one read
+    :param file: file object to read from
+    :param chunk_locations: list of (chunk, offset, size) tuples
+    :param max_gap: maximum number of unused bytes between two chunks for them to be read in one read
+    :param max_read_size: maximum size of a merged read
+    """
+    chunk_locations = sorted(chunk_locations, key=lambda location: (location[1], location[2]))
+    reads = plan_reads([(offset, size) for _, offset, size in chunk_locations], max_gap, max_read_size)
+    LOGGER.debug("Reading %d chunks in %d reads", len(chunk_locations), len(reads))
+
+    pos = 0
+    for read_offset, read_size in reads:
+        file.seek(read_offset)
+        read_data = memoryview(file.read(read_size))
+        read_end = read_offset + read_size
+
+        # Split the read up between the chunks it covers
+        while pos < len(chunk_locations) and chunk_locations[pos][1] + chunk_locations[pos][2] <= read_end:
+            chunk, offset, size = chunk_locations[pos]
+            chunk.raw_data = bytes(read_data[offset - read_offset:offset - read_offset + size])
+            pos += 1
+
+
+def read_index_data(file, index_offset, index_size=None):
+    """
+    Read the index header, chunk attributes and index entries in one go
+    :param file: file object to read from
+    :param index_offset: offset of the index in the file
+    :param index_size: optional, size of the index from the file header
+    :return: tuple of parsed index header, chunk attribute data and index entry data
+    """
+    if index_size is None:
+        # Read the index header to find out how big the rest of the index is
+        file.seek(index_offset)
+        index_header = parse_index_header(file.read(INDEX_HEADER_SIZE))
+        index_size = INDEX_HEADER_SIZE + index_header["entries_size"] + (
+                INDEX_ENTRY_SIZE * index_header["number_of_entries"])
+
     file.seek(index_offset)
-    index_header_data = file.read(INDEX_HEADER_SIZE)
-    index_header = parse_index_header(index_header_data)
+    index_data = memoryview(file.read(index_size))
+    index_header = parse_index_header(index_data[0:INDEX_HEADER_SIZE])
     LOGGER.debug("Parsed index header: %s", index_header)
-    number_of_chunks = index_header["number_of_entries"]
 
-    # Read each index entry to get the address of the chunk attributes
-    file.seek(index_offset + INDEX_HEADER_SIZE + index_header["entries_size"])
+    # Each index entry has the address of the chunk attributes
+    attributes_data = index_data[INDEX_HEADER_SIZE:INDEX_HEADER_SIZE + index_header["entries_size"]]
+    entries_offset = INDEX_HEADER_SIZE + index_header["entries_size"]
+    entries_size = INDEX_ENTRY_SIZE * index_header["number_of_entries"]
+    entries_data = index_data[entries_offset:entries_offset + entries_size]
+    check_size(entries_size, len(entries_data), "Index entries")
+
+    return index_header, attributes_data, entries_data
+
+
+def read_index(file, index_offset, index_size=None, data_view=None, lazy=False, max_gap=DEFAULT_MAX_READ_GAP,
+               data_source=None):
+    """
+    Read the chunk index and the data for each chunk
+    :param file: file object to read from
+    :param index_offset: offset of the index in the file
+    :param index_size: optional, size of the index from the file header. If set, the whole index is read at once.
+    :param data_view: optional, memoryview of the whole file. If set, chunk data is sliced from this view instead of
+                      being read from the file.
+    :param lazy: if True, only read the index. Chunk data is read from the file the first time it is accessed, so
+                 the file must stay open for as long as the chunks are in use.
+    :param max_gap: chunks closer together in the file than this many bytes are read with a single read
+    :param data_source: optional, object with a read(offset, size) method to read chunk data from instead of the file
+    :return: list of chunks
+    """
+    # Chunk data that comes straight from the file is read in file order with coalesced reads
+    coalesce_reads = data_source is None and data_view is None
+    if data_source is None:
+        data_source = ViewDataSource(data_view) if data_view is not None else FileDataSource(file)
+    chunk_locations = []
+    stored_locations = []
 
-    index_entries = []
-    for i in range(0, number_of_chunks):
-        offset, size = struct.unpack("<2I", file.read(8))
-        index_entries.append((offset, size))
+    index_header, attributes_data, entries_data = read_index_data(file, index_offset, index_size)
 
     # Read attributes for each chunk
     chunks = []
     has_compressed_chunks = False
-    for (chunk_attributes_offset, chunk_attributes_size) in index_entries:
-        file.seek(index_offset + INDEX_HEADER_SIZE + chunk_attributes_offset)
-        chunk_attributes_data = file.read(chunk_attributes_size)
+    for (chunk_attributes_offset, chunk_attributes_size) in INDEX_ENTRY.iter_unpack(entries_data):
+        chunk_attributes_data = attributes_data[chunk_attributes_offset:chunk_attributes_offset + chunk_attributes_size]
 
         attrs = parse_chunk_attributes(chunk_attributes_data)
         LOGGER.debug(attrs)
 
-        # Read chunk data
-        file.seek(attrs["offset"])
-        chunk_data = file.read(attrs["size"])
-
         if not has_compressed_chunks and attrs["flags"] & model.ChunkFlags.Compressed:
             has_compressed_chunks = True
 
         # Create a new chunk
         children = [model.ChunkChild(t["chid"], model.ChunkId(t["tag"], t["number"])) for t in attrs["children"]]
         name = attrs.get("name")
-        this_chunk = model.Chunk(attrs["tag"], attrs["number"], flags=attrs["flags"],
-                                 data=chunk_data, children=children, name=name)
+        this_chunk = model.Chunk(attrs["tag"], attrs["number"], flags=attrs["flags"], children=children, name=name)
+
+        # Read chunk data
+        if lazy:
+            this_chunk.defer_data(data_source, attrs["offset"], attrs["size"])
+        elif coalesce_reads:
+            chunk_locations.append((this_chunk, attrs["offset"], attrs["size"]))
+        else:
+            this_chunk.raw_data = data_source.read(attrs["offset"], attrs["size"])
+
+        stored_locations.append((this_chunk, attrs["offset"], attrs["size"]))
         chunks.append(this_chunk)
 
+    # The index is sorted by chunk ID, so read the chunk data in file order instead
+    if chunk_locations:
+        read_chunk_data(file, chunk_locations, max_gap)
+
+    # Remember where the data is, so that unmodified chunks can be left in place when the file is saved
+    for this_chunk, offset, size in stored_locations:
+        this_chunk.set_stored_location(offset, size, loaded=True)
+
     return chunks
 
 
-def load_from_file(file):
+def iter_chunk_headers(file):
+    """
+    Iterate over the chunk attributes in the index of a chunky file without reading chunk data or creating Chunk
+    objects. Only a small part of the index is in memory at a time.
+    :param file: File object to read from
+    :return: generator of dicts as returned by parse_chunk_attributes
+    """
+    file.seek(0)
+    file_header = parse_file_header(file.read(FILE_HEADER_SIZE))
+    index_offset = file_header["index_offset"]
+
+    file.seek(index_offset)
+    index_header = parse_index_header(file.read(INDEX_HEADER_SIZE))
+    attributes_offset = index_offset + INDEX_HEADER_SIZE
+    entries_offset = attributes_offset + index_header["entries_size"]
+
+    for first_entry in range(0, index_header["number_of_entries"], INDEX_ENTRY_BATCH_SIZE):
+        number_of_entries = min(INDEX_ENTRY_BATCH_SIZE, index_header["number_of_entries"] - first_entry)
+        file.seek(entries_offset + first_entry * INDEX_ENTRY_SIZE)
+        entries_data = file.read(number_of_entries * INDEX_ENTRY_SIZE)
+        check_size(number_of_entries * INDEX_ENTRY_SIZE, len(entries_data), "Index entries")
+
+        for (chunk_attributes_offset, chunk_attributes_size) in INDEX_ENTRY.iter_unpack(entries_data):
+            file.seek(attributes_offset + chunk_attributes_offset)
+            yield parse_chunk_attributes(file.read(chunk_attributes_size))
+
+
+def load_chunk_table(file):
+    """
+    Load the index of a 3DMM chunky file into a compact ChunkTable. Chunk data is read from the file when it is
+    accessed, so the file must be kept open while the table is in use.
+    :param file: File object to read from
+    :return: a ChunkTable
+    """
+    file_header = parse_file_header(file.read(FILE_HEADER_SIZE))
+    LOGGER.debug("Parsed file header: %s", file_header)
+
+    index_header, attributes_data, entries_data = read_index_data(file, file_header["index_offset"],
+                                                                  file_header["index_size"])
+
+    table = ChunkTable(file_header["file_type"], file_header["endianness"], file_header["characterset"],
+                       data_source=FileDataSource(file))
+    for (chunk_attributes_offset, chunk_attributes_size) in INDEX_ENTRY.iter_unpack(entries_data):
+        chunk_attributes_data = attributes_data[chunk_attributes_offset:chunk_attributes_offset + chunk_attributes_size]
+        check_size(CHUNK_ATTRIBUTES_HEADER_SIZE, len(chunk_attributes_data), "Chunk attributes")
+
+        tag_code, number, offset, flags_and_size, number_of_children, _ = \
+            CHUNK_ATTRIBUTES_HEADER_RAW.unpack_from(chunk_attributes_data)
+
+        children_end = CHUNK_ATTRIBUTES_HEADER_SIZE + number_of_children * CHUNK_CHILD_SIZE
+        check_size(children_end, len(chunk_attributes_data), "Chunk attributes list")
+        children = CHUNK_CHILD_RAW.iter_unpack(chunk_attributes_data[CHUNK_ATTRIBUTES_HEADER_SIZE:children_end])
+
+        # If we have trailing data, this is the chunk name
+        name = None
+        if children_end != len(chunk_attributes_data):
+            name, _, _ = parse_pascal_string_with_encoding(chunk_attributes_data[children_end:])
+
+        table.append(tag_code, number, offset, flags_and_size >> 8, flags_and_size & 0xFF, children, name)
+
+    return table
+
+
+def load_from_file(file, data_view=None, backing=None, lazy=False, max_gap=DEFAULT_MAX_READ_GAP, data_source=None):
     """
     Load a 3DMM chunky file
     :param file: File object to read from
+    :param data_view: optional, memoryview of the whole file to slice chunk data from
+    :param backing: optional, object that owns the memory behind data_view. Closed when the chunky file is closed.
+    :param lazy: if True, defer reading chunk data until it is accessed. The file must be kept open.
+    :param max_gap: chunks closer together in the file than this many bytes are read with a single read
+    :param data_source: optional, object with a read(offset, size) method to read chunk data from instead of the file
     :return: a chunky file object
     """
 
@@ -183,8 +385,46 @@ def load_from_file(file):
     file_header = parse_file_header(file_header_data)
     LOGGER.debug("Parsed file header: %s", file_header)
 
-    chunks = read_index(file, file_header["index_offset"])
+    chunks = read_index(file, file_header["index_offset"], file_header["index_size"], data_view=data_view, lazy=lazy,
+                        max_gap=max_gap, data_source=data_source)
 
     this_file = model.ChunkyFile(file_header["endianness"], file_header["characterset"], chunks=chunks,
-                                 file_type=file_header["file_type"])
+                                 file_type=file_header["file_type"], backing=backing)
     return this_file
+
+
+def load_from_path(path, mmap=False, lazy=False, max_gap=DEFAULT_MAX_READ_GAP):
+    """
+    Load a 3DMM chunky file from a path
+    :param path: path to the chunky file
+    :param mmap: if True, map the file into memory and make each chunk's raw_data a read-only memoryview of the
+                 mapping instead of a copy. The mapping stays open until the chunky file is closed.
+    :param lazy: if True, only read the index. Chunk data is read when it is first accessed, and the file stays open
+                 until the chunky file is closed.
+    :param max_gap: chunks closer together in the file than this many bytes are read with a single read
+    :return: a chunky file object
+    """
+    if mmap:
+        with open(path, "rb") as file:
+            mapping = mmapfile.mmap(file.fileno(), 0, access=mmapfile.ACCESS_READ)
+        data_view = memoryview(mapping)
+        try:
+            return load_from_file(mapping, data_view=data_view, backing=mapping, lazy=lazy)
+        except Exception:
+            data_view.release()
+            try:
+                mapping.close()
+            except BufferError:
+                # Chunks created before the error still refer to the mapping: it is closed when they are freed
+                pass
+            raise
+    elif lazy:
+        file = open(path, "rb")
+        try:
+            return load_from_file(file, backing=file, lazy=True)
+        except Exception:
+            file.close()
+            raise
+    else:
+        with open(path, "rb") as file:
+            return load_from_file(file, max_gap=max_gap)
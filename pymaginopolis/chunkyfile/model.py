@@ -1,6 +1,12 @@
-from collections import namedtuple
+import logging
+from collections import namedtuple, deque
 from enum import IntEnum, IntFlag
 
+from pymaginopolis.chunkyfile import cache as cache
+from pymaginopolis.chunkyfile import codecs as codecs
+
+LOGGER = logging.getLogger(__name__)
+
 
 class Endianness(IntEnum):
     """ Endianness of pointers inside the file. """
@@ -48,18 +54,131 @@ class ChunkChild(namedtuple("ChunkChild", field_names=["chid", "ref"])):
 
 
 class Chunk:
+    __slots__ = ("chunk_id", "name", "_data", "_data_location", "_stored_location", "_loaded_location", "_revision",
+                 "flags", "_children")
+
+    # Incremented whenever the children of any chunk are replaced, so that chunky files know to rebuild their parent
+    # index
+    children_revision = 0
+
     def __init__(self, tag, number, name=None, flags=None, data=None, children=None):
         self.chunk_id = ChunkId(tag, number)
         self.name = name
-        self.raw_data = data
+        self._data = data
+        # Where to read the data from if it has not been loaded yet: tuple of (source, offset, size)
+        self._data_location = None
+        # Where the data is in the file the chunk was loaded from or last saved to: tuple of (offset, size)
+        self._stored_location = None
+        # Where the data is in the file the chunk was loaded from: tuple of (offset, size)
+        self._loaded_location = None
+        # Incremented when the data is replaced, so that decoded copies of the old data are not used
+        self._revision = 0
         self.flags = flags if flags is not None else ChunkFlags.Default
-        self.children = children if children else list()
+        # Chunks that are not in a file yet don't need to invalidate any parent index
+        self._children = tuple(children) if children else ()
+
+    def defer_data(self, source, offset, size):
+        """
+        Read chunk data from a data source the first time it is accessed
+        :param source: object with a read(offset, size) method
+        :param offset: offset of the chunk data in the source
+        :param size: size of the chunk data
+        """
+        self._data = None
+        self._data_location = (source, offset, size)
+
+    def set_stored_location(self, offset, size, loaded=False):
+        """
+        Record where the chunk data is stored in the chunky file on disk. Cleared when the data is changed.
+        :param offset: offset of the chunk data in the file
+        :param size: size of the chunk data
+        :param loaded: True if the file is the one the chunk was loaded from. Otherwise, the location of the data in
+                       the file it was loaded from is kept.
+        """
+        self._stored_location = (offset, size)
+        if loaded:
+            self._loaded_location = (offset, size)
+
+    @property
+    def children(self):
+        """ Tuple of ChunkChild. Assign a new sequence to change the children. """
+        return self._children
+
+    @children.setter
+    def children(self, value):
+        self._children = tuple(value)
+        Chunk.children_revision += 1
+
+    @property
+    def stored_location(self):
+        """ Tuple of (offset, size) of the unmodified chunk data in the file on disk, or None if it is modified. """
+        return self._stored_location
+
+    @property
+    def loaded_location(self):
+        """
+        Tuple of (offset, size) of the unmodified chunk data in the file the chunk was loaded from, or None if it is
+        modified. Unlike stored_location, this does not change when the chunk is saved to another file.
+        """
+        return self._loaded_location
+
+    @property
+    def is_modified(self):
+        """ True if the chunk data is new or has changed since it was loaded or saved. """
+        return self._stored_location is None
+
+    @property
+    def is_loaded(self):
+        """ True if the chunk data is in memory. """
+        return self._data_location is None
+
+    @property
+    def data_size(self):
+        """ Size of the chunk data as stored in the file, without loading it. """
+        if self._data_location is not None:
+            return self._data_location[2]
+        return len(self._data) if self._data is not None else 0
+
+    @property
+    def raw_data(self):
+        """ Get the chunk data as stored in the file. Loads the data if it has not been loaded yet. """
+        if self._data_location is not None:
+            source, offset, size = self._data_location
+            self._data = source.read(offset, size)
+            self._data_location = None
+        return self._data
+
+    @raw_data.setter
+    def raw_data(self, value):
+        self._data = value
+        self._data_location = None
+        self._stored_location = None
+        self._loaded_location = None
+        self._revision += 1
+
+    def set_data(self, data, compress=None, level=codecs.CompressionLevel.Default):
+        """
+        Set the chunk data, optionally compressing it
+        :param data: uncompressed data
+        :param compress: optional, CompressionType to compress the data with. The data is stored uncompressed if
+                         compressing it does not make it smaller.
+        :param level: CompressionLevel to use when compressing
+        """
+        if compress is not None and compress != codecs.CompressionType.Uncompressed:
+            compressed_data = codecs.compress(data, compress, level)
+            if len(compressed_data) < len(data):
+                self.raw_data = compressed_data
+                self.flags |= ChunkFlags.Compressed
+                return
+
+        self.raw_data = data
+        self.flags &= ~ChunkFlags.Compressed
 
     @property
     def decoded_data(self):
         """ Get chunk data. Decompress if compressed. """
         if self.flags & ChunkFlags.Compressed:
-            raise NotImplementedError("Chunk decompression not yet supported")
+            return codecs.decompress(self.raw_data)
         else:
             return self.raw_data
 
@@ -70,32 +189,249 @@ class Chunk:
 
 
 class ChunkyFile:
-    def __init__(self, endianness, characterset, file_type=None, chunks=None):
+    def __init__(self, endianness, characterset, file_type=None, chunks=None, backing=None, decoded_cache=None):
         self.file_type = file_type if file_type else "TEST"
         self.endianness = endianness
         self.characterset = characterset
-        self.chunks = chunks if chunks else []
+        # Objects that own the memory that chunk data may refer to (eg. memory mapped files)
+        self._backings = [backing] if backing is not None else []
+        # Decoded chunk data, see decode(). May be shared with other files.
+        self.decoded_cache = decoded_cache if decoded_cache is not None else cache.DecodedDataCache()
+
+        # Chunks are indexed by chunk ID and by tag
+        self._chunks = []
+        # Read-only copy of _chunks returned by the chunks property. Built when needed.
+        self._chunks_tuple = None
+        self._chunks_by_id = {}
+        self._chunks_by_tag = {}
+        # Map of chunk ID to the IDs of the chunks that refer to it. Built when needed.
+        self._parents = None
+        # Value of Chunk.children_revision when the map was built
+        self._parents_revision = None
+        if chunks:
+            for chunk in chunks:
+                self.add_chunk(chunk)
+
+    @property
+    def chunks(self):
+        """ Tuple of chunks in the file. Use add_chunk, remove_chunk and replace_chunk to modify it. """
+        if self._chunks_tuple is None:
+            self._chunks_tuple = tuple(self._chunks)
+        return self._chunks_tuple
+
+    def add_chunk(self, chunk):
+        """ Add a new chunk to the file. Raises ValueError if there is already a chunk with the same chunk ID. """
+        if chunk.chunk_id in self._chunks_by_id:
+            raise ValueError("Chunk already exists: %s" % (chunk.chunk_id,))
+
+        self._chunks.append(chunk)
+        self._chunks_tuple = None
+        self._chunks_by_id[chunk.chunk_id] = chunk
+        self._chunks_by_tag.setdefault(chunk.chunk_id.tag, []).append(chunk)
+        self._parents = None
+
+    def remove_chunk(self, key):
+        """ Remove a chunk from the file by chunk ID. Returns the removed chunk. """
+        chunk_id = self._make_key(key)
+        chunk = self._chunks_by_id.pop(chunk_id)
+
+        self._chunks.remove(chunk)
+        self._chunks_tuple = None
+        tag_chunks = self._chunks_by_tag[chunk_id.tag]
+        tag_chunks.remove(chunk)
+        if not tag_chunks:
+            del self._chunks_by_tag[chunk_id.tag]
+        self._parents = None
+        self._discard_decoded(chunk_id)
+        return chunk
+
+    def replace_chunk(self, chunk):
+        """ Replace the chunk that has the same chunk ID as the given chunk. Returns the replaced chunk. """
+        old_chunk = self._chunks_by_id[chunk.chunk_id]
+
+        self._chunks[self._chunks.index(old_chunk)] = chunk
+        self._chunks_tuple = None
+        self._chunks_by_id[chunk.chunk_id] = chunk
+        tag_chunks = self._chunks_by_tag[chunk.chunk_id.tag]
+        tag_chunks[tag_chunks.index(old_chunk)] = chunk
+        self._parents = None
+        self._discard_decoded(chunk.chunk_id)
+        return old_chunk
+
+    def add_child(self, key, child):
+        """
+        Add a child to a chunk
+        :param key: chunk ID of the parent chunk
+        :param child: ChunkChild
+        """
+        chunk = self._chunks_by_id[self._make_key(key)]
+        chunk.children = chunk.children + (child,)
+        self._parents = None
+
+    def decode(self, key, decoder=None):
+        """
+        Get the decoded data of a chunk. The result is kept in the decoded data cache until the chunk data is
+        replaced, so decoding the same chunk again is cheap. Changes made to a mutable chunk data buffer in place
+        are not detected.
+        :param key: chunk ID
+        :param decoder: optional, function that parses decoded chunk data, eg. StringTable.from_buffer.
+                        If not set, the decompressed chunk data is returned.
+        :return: decoded chunk data, or the result of the decoder
+        """
+        chunk = self._chunks_by_id[self._make_key(key)]
+        if decoder is None and not chunk.flags & ChunkFlags.Compressed:
+            # Nothing to decode
+            return chunk.raw_data
+
+        def load():
+            if decoder is None:
+                data = chunk.decoded_data
+            else:
+                data = self.decode(chunk.chunk_id)
+            # Parsed objects are assumed to take about as much memory as the data they were parsed from
+            return (data if decoder is None else decoder(data)), len(data)
+
+        version = (chunk, chunk._revision, chunk.flags)
+        return self.decoded_cache.get((id(self), chunk.chunk_id, decoder), version, load)
+
+    def _discard_decoded(self, chunk_id=None):
+        """ Remove decoded data from the cache for one chunk, or for all chunks in the file """
+        file_identity = id(self)
+        self.decoded_cache.discard(lambda k: k[0] == file_identity and (chunk_id is None or k[1] == chunk_id))
+
+    def _get_parents(self):
+        """ Get the map of chunk IDs to parent chunk IDs, building it if the chunks or their children have changed """
+        if self._parents is None or self._parents_revision != Chunk.children_revision:
+            self._parents_revision = Chunk.children_revision
+            parents = {}
+            for chunk in self._chunks:
+                for child in chunk.children:
+                    parents.setdefault(child.ref, []).append(chunk.chunk_id)
+            self._parents = parents
+        return self._parents
+
+    def count_parents(self, key):
+        """ Get the number of references to a chunk from other chunks """
+        return len(self._get_parents().get(self._make_key(key), []))
+
+    def parents_of(self, key):
+        """ Get the list of chunks that have the given chunk as a child """
+        parent_ids = dict.fromkeys(self._get_parents().get(self._make_key(key), []))
+        return [self._chunks_by_id[parent_id] for parent_id in parent_ids]
+
+    def descendants_of(self, key, depth_first=False):
+        """
+        Iterate over the children of a chunk, their children and so on. Each chunk is returned once.
+        Children that refer to chunks that are not in the file are skipped.
+        :param key: chunk ID of the chunk to start from
+        :param depth_first: if True, walk the graph depth first. Otherwise, walk it breadth first.
+        """
+        start_id = self._make_key(key)
+        visited = set()
+        pending = deque([start_id])
+        while pending:
+            chunk_id = pending.pop() if depth_first else pending.popleft()
+            if chunk_id in visited:
+                continue
+            visited.add(chunk_id)
+
+            chunk = self._chunks_by_id.get(chunk_id)
+            if chunk is None:
+                continue
+            if chunk_id != start_id:
+                yield chunk
+
+            # Push children in reverse order for depth-first so they are visited in order
+            children = reversed(chunk.children) if depth_first else chunk.children
+            pending.extend(child.ref for child in children if child.ref not in visited)
+
+    def iter_topological(self):
+        """
+        Iterate over the chunks in the file so that each chunk comes before all of its children.
+        Raises ValueError if the chunk references contain a cycle.
+        """
+        parents = self._get_parents()
+        remaining_parents = {chunk_id: len(set(p)) for chunk_id, p in parents.items()}
+        ready = deque(c for c in self._chunks if c.chunk_id not in remaining_parents)
+        visited = 0
+        while ready:
+            chunk = ready.popleft()
+            visited += 1
+            yield chunk
+
+            for child_id in dict.fromkeys(child.ref for child in chunk.children):
+                remaining_parents[child_id] -= 1
+                if remaining_parents[child_id] == 0 and child_id in self._chunks_by_id:
+                    ready.append(self._chunks_by_id[child_id])
+
+        if visited != len(self._chunks):
+            raise ValueError("Chunk references contain a cycle")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def add_backing(self, backing):
+        """
+        Make the chunky file responsible for closing an object that owns memory that chunk data refers to
+        :param backing: object with a close() method, eg. a memory mapped file
+        """
+        self._backings.append(backing)
+
+    def close(self):
+        """ Release the memory backing the chunk data. Chunk data that refers to it is no longer valid. """
+        self._discard_decoded()
+        if not self._backings:
+            return
+
+        # Release views of the backing memory so that it can be closed, including the views held by the data
+        # sources of chunks that have not been read yet
+        data_sources = set()
+        for chunk in self.chunks:
+            if isinstance(chunk._data, memoryview) and any(chunk._data.obj is b for b in self._backings):
+                chunk._data.release()
+            elif chunk._data_location is not None:
+                data_sources.add(chunk._data_location[0])
+        for data_source in data_sources:
+            if hasattr(data_source, "release"):
+                data_source.release()
+
+        for backing in self._backings:
+            try:
+                backing.close()
+            except BufferError:
+                # Someone else still holds a view of the data: the memory is released when it is garbage collected
+                LOGGER.warning("Chunk data is still in use, could not close %s", backing)
+        self._backings = []
 
     def __str__(self):
         return "ChunkyFile: %s %s/%s - %d chunks" % (
             self.file_type, self.endianness.name, self.characterset.name, len(self.chunks))
 
-    def get_chunks(self, key):
+    @staticmethod
+    def _make_key(key):
+        """ Convert a lookup key into a ChunkId, or a tag padded to four characters """
         if type(key) is ChunkId:
             # Key is already a ChunkId
-            pass
-        elif type(key) is tuple and len(key) is 2:
+            return key
+        elif type(key) is tuple and len(key) == 2:
             # Create a new ChunkId from the type
-            key = ChunkId(tag=key[0], number=key[1])
+            return ChunkId(tag=key[0], number=key[1])
         elif type(key) is str and len(key) <= 4:
-            key = key + " " * (4 - len(key))
-            # Return a list of chunks with the given tag
-            return [c for c in self.chunks if c.chunk_id.tag == key]
+            return key + " " * (4 - len(key))
         else:
             raise NotImplementedError
 
-        found_chunks = [c for c in self.chunks if c.chunk_id == key]
-        return found_chunks
+    def get_chunks(self, key):
+        key = self._make_key(key)
+        if type(key) is str:
+            # Return a list of chunks with the given tag
+            return list(self._chunks_by_tag.get(key, []))
+
+        chunk = self._chunks_by_id.get(key)
+        return [chunk] if chunk is not None else []
 
     def __getitem__(self, key):
         """ Get a chunk or a list of chunks. Supports:
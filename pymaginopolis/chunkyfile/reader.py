@@ -0,0 +1,127 @@
+""" Pymaginopolis: thread-safe chunk data reader """
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+import pymaginopolis.chunkyfile.loader as loader
+from pymaginopolis.chunkyfile.common import FileParseException
+
+LOGGER = logging.getLogger(__name__)
+
+# Maximum number of bytes of chunk data to keep in the cache
+DEFAULT_CACHE_SIZE = 0x1000000
+
+
+class ChunkyReader:
+    """
+    Keeps a chunky file open and reads chunk data with positional reads, so that chunks can be read from several
+    threads at once without sharing a file position. Recently read chunk data is kept in a cache.
+    """
+
+    def __init__(self, path, cache_size=DEFAULT_CACHE_SIZE):
+        """
+        Open a chunky file
+        :param path: path to the chunky file
+        :param cache_size: maximum number of bytes of recently read chunk data to keep in memory
+        """
+        self.path = path
+        self.cache_size = cache_size
+        self._fd = os.open(path, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+        self._lock = threading.Lock()
+        # Number of reads using the file descriptor. If the reader is closed during a read, the file descriptor is
+        # closed when the read finishes, so that it isn't reused for another file while it is being read from.
+        self._active_reads = 0
+        self._closed = False
+        self._cache = OrderedDict()
+        self._cached_bytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            if self._active_reads == 0:
+                self._close_fd()
+            self._cache.clear()
+            self._cached_bytes = 0
+
+    def _close_fd(self):
+        """ Close the file descriptor. Must be called with the lock held. """
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def _pread(self, offset, size):
+        """ Read from the file without using a shared file position """
+        with self._lock:
+            if self._closed:
+                raise ValueError("Reader is closed")
+            self._active_reads += 1
+            fd = self._fd
+
+        try:
+            pieces = []
+            done = 0
+            while done < size:
+                if hasattr(os, "pread"):
+                    piece = os.pread(fd, size - done, offset + done)
+                else:
+                    # No positional reads on this platform, so serialise seek + read
+                    with self._lock:
+                        os.lseek(fd, offset + done, os.SEEK_SET)
+                        piece = os.read(fd, size - done)
+                if not piece:
+                    raise FileParseException("Chunk data at 0x%x is truncated: expected 0x%x bytes, got 0x%x" % (
+                        offset, size, done))
+                pieces.append(piece)
+                done += len(piece)
+            return b''.join(pieces)
+        finally:
+            with self._lock:
+                self._active_reads -= 1
+                if self._closed and self._active_reads == 0:
+                    self._close_fd()
+
+    def read(self, offset, size):
+        """
+        Read chunk data from the file
+        :param offset: offset of the data in the file
+        :param size: size of the data
+        :return: bytes
+        """
+        key = (offset, size)
+        with self._lock:
+            data = self._cache.get(key)
+            if data is not None:
+                self._cache.move_to_end(key)
+                return data
+
+        # Read outside of the lock so other threads aren't blocked on I/O
+        data = self._pread(offset, size)
+
+        if len(data) <= self.cache_size:
+            with self._lock:
+                if key not in self._cache:
+                    self._cache[key] = data
+                    self._cached_bytes += len(data)
+
+                # Evict the least recently used chunk data
+                while self._cached_bytes > self.cache_size:
+                    _, evicted_data = self._cache.popitem(last=False)
+                    self._cached_bytes -= len(evicted_data)
+
+        return data
+
+    def load(self):
+        """
+        Load the chunky file. Chunk data is read through this reader when it is accessed, so the reader must be kept
+        open while the chunks are in use.
+        :return: a chunky file object
+        """
+        with open(self.path, "rb") as file:
+            return loader.load_from_file(file, lazy=True, data_source=self)
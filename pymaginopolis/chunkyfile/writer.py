@@ -1,5 +1,13 @@
+import errno
+import hashlib
+import io
+import mmap
+import os
 import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
+import pymaginopolis.chunkyfile.loader as loader
 import pymaginopolis.chunkyfile.model as model
 
 DEFAULT_VERSION = model.Version(5, 4)
@@ -21,6 +29,17 @@ CHARACTER_SETS = {
 FILE_HEADER_SIZE = 128
 INDEX_HEADER_SIZE = 20
 
+# Size of the buffer used to copy chunk data when the operating system can't copy it directly
+COPY_BUFFER_SIZE = 0x100000
+# Chunk data is gathered into writes of at least this many bytes
+WRITE_BUFFER_SIZE = 0x10000
+# Chunk data is copied into a memory mapped output in batches of about this many bytes
+MAPPED_BATCH_SIZE = 0x100000
+
+# Errors that mean that copy_file_range or sendfile can't be used for a pair of files
+COPY_UNSUPPORTED_ERRORS = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF, errno.EPERM,
+                           errno.ENOTSOCK}
+
 
 def string_to_tag_bytes(tag_str):
     """
@@ -91,85 +110,417 @@ def generate_chunk_attributes(chunk, file_offset, data_size, number_of_parents):
     return ca
 
 
-def write_to_file(chunky_file, file):
+def write_to_file(chunky_file, file, template=None, deduplicate=False):
     """
-    Save a 3DMM chunky file
+    Save a 3DMM chunky file. The layout of the file is worked out first, and then the file is written from start to
+    end without seeking, so the output can be a pipe.
     :param chunky_file: ChunkyFile object
     :param file: file to write to
+    :param template: optional, the file that the chunky file was loaded from, opened for reading. The data of
+                     unmodified chunks is copied from the template to the output by the operating system, without
+                     reading it into memory. Load the chunky file with lazy=True so that it isn't read at all.
+    :param deduplicate: if True, chunks with identical data share one copy of it in the file
+    :return: number of bytes of duplicate chunk data that were not written
     """
 
     # File layout:
     # Header | Chunk Data | Index Header | Chunk Attributes | Index Entries | Post-Index
+    chunk_info, index, header = plan_layout(chunky_file, deduplicate)
+
+    file.write(header)
+    _write_chunk_data(chunky_file, file, template, chunk_info)
+    file.write(index)
+
+    _set_stored_locations(chunky_file, chunk_info)
+    return _duplicate_size(chunk_info)
 
-    # Reserve 128 bytes for the header
-    file.seek(128)
 
-    # Write out the data for each chunk
+def write_mapped(chunky_file, file, template=None, jobs=None, deduplicate=False):
+    """
+    Save a 3DMM chunky file by mapping the output file into memory and copying the chunk data into it from a pool of
+    threads. The index and header are written last. The output is the same as write_to_file.
+    :param chunky_file: ChunkyFile object
+    :param file: file to write to, opened in "w+b" mode. Must be a file on disk so that it can be memory mapped.
+    :param template: optional, the file that the chunky file was loaded from, opened for reading. The data of
+                     unmodified chunks is read from the template straight into the mapped output.
+    :param jobs: number of threads. Defaults to the number of CPUs.
+    :param deduplicate: if True, chunks with identical data share one copy of it in the file
+    :return: number of bytes of duplicate chunk data that were not written
+    """
+    chunk_info, index, header = plan_layout(chunky_file, deduplicate)
+    index_offset = FILE_HEADER_SIZE + sum(info["size"] for info in chunk_info.values() if not info["duplicate"])
+    total_file_size = index_offset + len(index)
+
+    # Make the file the right size, then map it
+    file.flush()
+    os.ftruncate(file.fileno(), total_file_size)
+    mapping = mmap.mmap(file.fileno(), total_file_size)
+    try:
+        view = memoryview(mapping)
+        try:
+            template_fd = template.fileno() if template is not None else None
+            template_lock = threading.Lock()
+            with ThreadPoolExecutor(max_workers=jobs) as pool:
+                futures = [pool.submit(_copy_batch, view, batch, template_fd, template_lock)
+                           for batch in _plan_batches(chunky_file, chunk_info, template is not None)]
+                for future in futures:
+                    future.result()
+
+            view[index_offset:total_file_size] = index
+            view[0:FILE_HEADER_SIZE] = header
+        finally:
+            view.release()
+        mapping.flush()
+    finally:
+        mapping.close()
+
+    _set_stored_locations(chunky_file, chunk_info)
+    return _duplicate_size(chunk_info)
+
+
+def _plan_batches(chunky_file, chunk_info, use_template):
+    """
+    Split the chunk data into batches to copy into the mapped output
+    :return: generator of lists of (output offset, data, template offset, size). If data is None, the data is copied
+             from the template.
+    """
+    batch = []
+    batch_size = 0
+    for chunk in chunky_file.chunks:
+        if chunk_info[chunk.chunk_id]["duplicate"]:
+            continue
+        destination_offset = chunk_info[chunk.chunk_id]["offset"]
+        if use_template and chunk.loaded_location is not None:
+            source_offset, size = chunk.loaded_location
+            if batch and batch[-1][1] is None and batch[-1][2] + batch[-1][3] == source_offset:
+                # Next to the previous chunk in both files: copy them at once
+                previous = batch[-1]
+                batch[-1] = (previous[0], None, previous[2], previous[3] + size)
+            else:
+                batch.append((destination_offset, None, source_offset, size))
+        else:
+            # Chunk data sources aren't thread safe, so get the data here
+            data = chunk.encoded_data
+            # Data of the wrong size would leave a gap or overwrite the next chunk
+            _check_data_size(chunk, data, chunk_info)
+            size = len(data)
+            batch.append((destination_offset, data, None, size))
+
+        batch_size += size
+        if batch_size >= MAPPED_BATCH_SIZE:
+            yield batch
+            batch = []
+            batch_size = 0
+
+    if batch:
+        yield batch
+
+
+def _copy_batch(view, batch, template_fd, template_lock):
+    """ Copy a batch of chunk data into the mapped output """
+    for destination_offset, data, source_offset, size in batch:
+        destination = view[destination_offset:destination_offset + size]
+        if data is None:
+            _read_into(template_fd, destination, source_offset, template_lock)
+        else:
+            destination[:] = data
+
+
+def _read_into(fd, buffer, offset, lock):
+    """ Read from a file descriptor at an offset into a buffer, without using the shared file position if possible """
+    done = 0
+    while done < len(buffer):
+        if hasattr(os, "preadv"):
+            result = os.preadv(fd, [buffer[done:]], offset + done)
+        else:
+            if hasattr(os, "pread"):
+                data = os.pread(fd, len(buffer) - done, offset + done)
+            else:
+                with lock:
+                    os.lseek(fd, offset + done, os.SEEK_SET)
+                    data = os.read(fd, len(buffer) - done)
+            buffer[done:done + len(data)] = data
+            result = len(data)
+
+        if result == 0:
+            raise ValueError("Template file ends before the chunk data at 0x%x" % (offset + done,))
+        done += result
+
+
+def plan_layout(chunky_file, deduplicate=False):
+    """
+    Work out where everything goes in a chunky file from the sizes of the chunks
+    :param chunky_file: ChunkyFile object
+    :param deduplicate: if True, chunks with the same data as an earlier chunk point at its data instead of having
+                        their own copy
+    :return: tuple of (dictionary of chunk ID to the offset and size of the chunk data and whether it is a duplicate,
+             index data, file header)
+    """
+    duplicates = find_duplicate_chunks(chunky_file) if deduplicate else {}
+
+    # The chunk data follows the 128 byte header, in the same order as the chunks
     chunk_info = {}
+    position = FILE_HEADER_SIZE
+    for chunk in chunky_file.chunks:
+        data_size = chunk.data_size
+        original_id = duplicates.get(chunk.chunk_id)
+        if original_id is not None:
+            chunk_info[chunk.chunk_id] = {"offset": chunk_info[original_id]["offset"], "size": data_size,
+                                          "duplicate": True}
+            continue
+        chunk_info[chunk.chunk_id] = {"offset": position, "size": data_size, "duplicate": False}
+        position += data_size
+
+    index_offset = position
+    index = generate_index(chunky_file, chunk_info)
+    header = generate_file_header(index_offset + len(index), index_offset, len(index))
+    return chunk_info, index, header
+
+
+def find_duplicate_chunks(chunky_file):
+    """
+    Find chunks whose data is the same as the data of an earlier chunk. Only chunks that are the same size as another
+    chunk are read and hashed.
+    :param chunky_file: ChunkyFile object
+    :return: dictionary of chunk ID to the ID of the first chunk with the same data
+    """
+    chunks_by_size = {}
+    for chunk in chunky_file.chunks:
+        if chunk.data_size:
+            chunks_by_size.setdefault(chunk.data_size, []).append(chunk)
+
+    duplicates = {}
+    for same_size_chunks in chunks_by_size.values():
+        if len(same_size_chunks) < 2:
+            continue
+        original_ids = {}
+        for chunk in same_size_chunks:
+            digest = hashlib.sha256(chunk.encoded_data).digest()
+            original_id = original_ids.setdefault(digest, chunk.chunk_id)
+            if original_id != chunk.chunk_id:
+                duplicates[chunk.chunk_id] = original_id
+    return duplicates
+
+
+def _check_data_size(chunk, data, chunk_info):
+    """ Raise ValueError if chunk data is not the size that the layout of the file was worked out with """
+    if len(data) != chunk_info[chunk.chunk_id]["size"]:
+        raise ValueError("%s: expected 0x%x bytes of chunk data, got 0x%x" % (
+            chunk.chunk_id, chunk_info[chunk.chunk_id]["size"], len(data)))
+
+
+def _duplicate_size(chunk_info):
+    """ Total size of the chunk data that is shared with another chunk instead of being written again """
+    return sum(info["size"] for info in chunk_info.values() if info["duplicate"])
+
+
+def _write_chunk_data(chunky_file, file, template, chunk_info):
+    """
+    Write the data for each chunk in order. Small chunks are gathered into larger writes. If there is a template, the
+    data of unmodified chunks is copied from it, and consecutive unmodified chunks that are next to each other in
+    the template are copied at once. Duplicate chunks are skipped.
+    """
+    buffer = bytearray()
+    # Range of the template that still needs to be copied
+    copy_offset = 0
+    copy_size = 0
     for chunk in chunky_file.chunks:
+        if chunk_info[chunk.chunk_id]["duplicate"]:
+            continue
+        if template is not None and chunk.loaded_location is not None:
+            offset, data_size = chunk.loaded_location
+            if copy_size and offset != copy_offset + copy_size:
+                copy_file_range(template, copy_offset, file, copy_size)
+                copy_size = 0
+            if buffer:
+                file.write(buffer)
+                buffer.clear()
+            if not copy_size:
+                copy_offset = offset
+            copy_size += data_size
+            continue
+
+        if copy_size:
+            copy_file_range(template, copy_offset, file, copy_size)
+            copy_size = 0
+
         this_chunk_data = chunk.encoded_data
-        this_chunk_offset = file.tell()
-        file.write(this_chunk_data)
-
-        # Keep track of chunk offsets and sizes
-        if chunk.chunk_id not in chunk_info:
-            chunk_info[chunk.chunk_id] = dict()
-        chunk_info[chunk.chunk_id]["offset"] = this_chunk_offset
-        chunk_info[chunk.chunk_id]["size"] = len(this_chunk_data)
-
-        # While we're here, keep track of the number of parents of each chunk
-        for child in chunk.children:
-            if child.ref not in chunk_info:
-                chunk_info[child.ref] = dict()
-            if chunk_info[child.ref].get("parents") is None:
-                chunk_info[child.ref]["parents"] = 1
-            else:
-                chunk_info[child.ref]["parents"] += 1
+        # The offsets in the header and index are already written, so they would all be wrong after this chunk
+        _check_data_size(chunk, this_chunk_data, chunk_info)
+        if len(this_chunk_data) >= WRITE_BUFFER_SIZE:
+            if buffer:
+                file.write(buffer)
+                buffer.clear()
+            file.write(this_chunk_data)
+        else:
+            buffer += this_chunk_data
+            if len(buffer) >= WRITE_BUFFER_SIZE:
+                file.write(buffer)
+                buffer.clear()
+
+    if copy_size:
+        copy_file_range(template, copy_offset, file, copy_size)
+    if buffer:
+        file.write(buffer)
+
+
+def write_incremental(chunky_file, file):
+    """
+    Save changes to a chunky file in place. The data of new and modified chunks is appended to the end of the file,
+    followed by a new index, and then the header is updated. The data of unmodified chunks is left where it is, so
+    the file must be the one the chunky file was loaded from or last saved to, opened for reading and writing.
+    The old index and the old data of modified chunks are left in the file as unused space; use write_to_file to
+    write a compact file.
+    :param chunky_file: ChunkyFile object
+    :param file: file to update, opened in "r+b" mode
+    :return: number of bytes written
+    """
+    # Make sure that this is a chunky file
+    file.seek(0)
+    loader.parse_file_header(file.read(loader.FILE_HEADER_SIZE))
+    existing_size = file.seek(0, 2)
+
+    # Append new and modified chunk data after everything that is in the file already, so that the file is still
+    # valid if the update is interrupted before the header is written
+    chunk_info = {}
+    for chunk in chunky_file.chunks:
+        if chunk.is_modified:
+            this_chunk_data = chunk.encoded_data
+            chunk_info[chunk.chunk_id] = {"offset": file.tell(), "size": len(this_chunk_data)}
+            file.write(this_chunk_data)
+        else:
+            offset, size = chunk.stored_location
+            if offset + size > existing_size:
+                raise ValueError("%s: chunk data is outside of the file, was the chunky file loaded from it?"
+                                 % (chunk.chunk_id,))
+            chunk_info[chunk.chunk_id] = {"offset": offset, "size": size}
 
-    # Reserve space for the index header
     index_offset = file.tell()
-    # file.write(b'\x00' * 0x14)
-    file.seek(INDEX_HEADER_SIZE, 1)
+    index = generate_index(chunky_file, chunk_info)
+    file.write(index)
+    file.flush()
 
-    # Write out attributes for each chunk.
-    index_entries = list()
+    # Write the new header last
+    total_file_size = index_offset + len(index)
+    header = generate_file_header(total_file_size, index_offset, len(index), chunky_file.file_type)
+    file.seek(0)
+    file.write(header)
+    file.flush()
 
-    ca_total_size = 0
+    _set_stored_locations(chunky_file, chunk_info)
+    return total_file_size - existing_size + len(header)
+
+
+def copy_file_range(source, source_offset, destination, size):
+    """
+    Copy part of a file to the current position of another file. Uses os.copy_file_range or os.sendfile if they
+    are available, so that the data is copied by the operating system, and falls back to a buffered copy.
+    :param source: file object to copy from
+    :param source_offset: offset of the data in the source file
+    :param destination: file object to copy to. The position is moved to the end of the copied data.
+    :param size: number of bytes to copy
+    """
+    try:
+        source_fd = source.fileno()
+        destination_fd = destination.fileno()
+    except (AttributeError, io.UnsupportedOperation):
+        # Not a real file, eg. BytesIO
+        _copy_buffered(source, source_offset, destination, size)
+        return
+
+    destination.flush()
+    # Pipes can't seek: data is written at their current position
+    destination_offset = destination.tell() if destination.seekable() else None
+    copied = _copy_with_os(source_fd, source_offset, destination_fd, destination_offset, size)
+    if destination_offset is not None:
+        destination.seek(destination_offset + copied)
+    if copied < size:
+        _copy_buffered(source, source_offset + copied, destination, size - copied)
+
+
+def _copy_with_os(source_fd, source_offset, destination_fd, destination_offset, size):
+    """
+    Copy data between two file descriptors without reading it into memory. Returns the number of bytes copied.
+    If destination_offset is None, the data is written at the current position of the destination.
+    """
+    copied = 0
+    if hasattr(os, "copy_file_range"):
+        try:
+            while copied < size:
+                result = os.copy_file_range(source_fd, destination_fd, size - copied, source_offset + copied,
+                                            None if destination_offset is None else destination_offset + copied)
+                if result == 0:
+                    # End of the source file
+                    return copied
+                copied += result
+            return copied
+        except OSError as e:
+            if e.errno not in COPY_UNSUPPORTED_ERRORS:
+                raise
+
+    if hasattr(os, "sendfile"):
+        try:
+            # sendfile writes at the current position of the destination
+            if destination_offset is not None:
+                os.lseek(destination_fd, destination_offset + copied, os.SEEK_SET)
+            while copied < size:
+                result = os.sendfile(destination_fd, source_fd, source_offset + copied, size - copied)
+                if result == 0:
+                    return copied
+                copied += result
+        except OSError as e:
+            if e.errno not in COPY_UNSUPPORTED_ERRORS:
+                raise
+    return copied
+
+
+def _copy_buffered(source, source_offset, destination, size):
+    """ Copy data between two file objects through a buffer """
+    source.seek(source_offset)
+    while size > 0:
+        data = source.read(min(size, COPY_BUFFER_SIZE))
+        if not data:
+            raise ValueError("Template file ends before the chunk data at 0x%x" % (source_offset,))
+        destination.write(data)
+        size -= len(data)
+
+
+def _set_stored_locations(chunky_file, chunk_info):
+    """
+    Record where the chunk data was written, so that the next incremental save can leave it in place. The location
+    of the data in the file the chunks were loaded from is kept, so that it can still be copied from the template.
+    """
     for chunk in chunky_file.chunks:
+        chunk.set_stored_location(chunk_info[chunk.chunk_id]["offset"], chunk_info[chunk.chunk_id]["size"])
 
+
+def generate_index(chunky_file, chunk_info):
+    """
+    Generate the index: the index header, the attributes of each chunk and the sorted index entries
+    :param chunky_file: ChunkyFile object
+    :param chunk_info: dictionary of chunk ID to a dictionary with the offset and size of the chunk data in the file
+    :return: index data
+    """
+    # Generate attributes for each chunk.
+    attributes = bytearray()
+    index_entries = list()
+    for chunk in chunky_file.chunks:
         file_offset = chunk_info[chunk.chunk_id]["offset"]
         data_size = chunk_info[chunk.chunk_id]["size"]
-        number_of_parents = chunk_info[chunk.chunk_id].get("parents", 0)
+        number_of_parents = chunky_file.count_parents(chunk.chunk_id)
 
         ca = generate_chunk_attributes(chunk, file_offset, data_size, number_of_parents)
-
-        this_ca_pos = ca_total_size
-        this_ca_size = len(ca)
-        ca_total_size += this_ca_size
-
-        index_entries.append((chunk.chunk_id, this_ca_pos, this_ca_size))
-        file.write(ca)
+        index_entries.append((chunk.chunk_id, len(attributes), len(ca)))
+        attributes += ca
 
         # Chunk attribute lists generated by 3DMM are aligned to four bytes
-        padding = (4 - (ca_total_size % 4))
+        padding = (4 - (len(attributes) % 4))
         if padding < 4:
-            file.write(b'\x00' * padding)
-            ca_total_size += padding
+            attributes += b'\x00' * padding
 
-    # Write the index entries
+    # Generate the index entries
     # the index should be sorted by chunk tag and chunk number
-    for chunk_id, chunk_pos, chunk_size in sorted(index_entries, key=lambda i: i[0]):
-        index_entry = struct.pack("<II", chunk_pos, chunk_size)
-        file.write(index_entry)
+    entries = b''.join(struct.pack("<II", chunk_pos, chunk_size)
+                       for chunk_id, chunk_pos, chunk_size in sorted(index_entries, key=lambda i: i[0]))
 
-    total_file_size = file.tell()
-
-    # Write index header
-    file.seek(index_offset)
-    file.write(generate_index_header(len(index_entries), ca_total_size))
-
-    # Write header at the start of the file
-    index_size = total_file_size - index_offset
-    header = generate_file_header(total_file_size, index_offset, index_size)
-    file.seek(0)
-    file.write(header)
+    return generate_index_header(len(index_entries), len(attributes)) + attributes + entries
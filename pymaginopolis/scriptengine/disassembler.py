@@ -1,3 +1,4 @@
+import io
 import logging
 import struct
 
@@ -132,3 +133,8 @@ def disassemble_script(stream):
         script.instructions.append(next_instruction)
 
     return script
+
+
+def disassemble_script_data(data):
+    """ Disassemble a script from GLSC / GLOP chunk data """
+    return disassemble_script(io.BytesIO(data))
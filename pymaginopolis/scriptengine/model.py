@@ -14,6 +14,8 @@ class DataType(enum.Enum):
 
 
 class Parameter:
+    __slots__ = ("name", "type", "description")
+
     def __init__(self, name, type=None, description=None):
         self.name = name
         self.type = type if type else DataType.Long
@@ -21,6 +23,8 @@ class Parameter:
 
 
 class Opcode:
+    __slots__ = ("opcode", "mnemonic", "varargs", "returns", "description", "parameters")
+
     def __init__(self, opcode, mnemonic=None, stack_params=0, varargs=False, returns=None, description=None):
         self.opcode = opcode
         self.mnemonic = mnemonic if mnemonic else "opcode_0x%x" % opcode
@@ -34,6 +38,8 @@ class Opcode:
 
 
 class Instruction:
+    __slots__ = ("opcode", "params", "variable", "original_bytes", "address")
+
     def __init__(self, opcode, variable=None, params=None, original_bytes=None, address=None):
         self.opcode = opcode
         self.params = list(params) if params else list()
@@ -53,6 +59,8 @@ class Instruction:
 
 
 class Script:
+    __slots__ = ("endianness", "characterset", "compilerversion", "instructions")
+
     def __init__(self, endianness=None, characterset=None, compilerversion=None):
         self.endianness = endianness if endianness else chunkymodel.Endianness.LittleEndian
         self.characterset = characterset if characterset else chunkymodel.CharacterSet.ANSI
@@ -243,7 +243,7 @@ def parse_and_assemble(input_file, opcode_list, verbose=False):
                                                    number=string_table_chunk_number,
                                                    data=string_table_data)
 
-        chunky_file.chunks.append(string_table_chunk)
+        chunky_file.add_chunk(string_table_chunk)
 
     if script:
         if verbose:
@@ -260,9 +260,9 @@ def parse_and_assemble(input_file, opcode_list, verbose=False):
         if string_table:
             string_table_id = chunkyfilemodel.ChunkId(string_table_chunk_tag, string_table_chunk_number)
             string_table_child = chunkyfilemodel.ChunkChild(chid=0, ref=string_table_id)
-            script_chunk.children.append(string_table_child)
+            script_chunk.children = [string_table_child]
 
-        chunky_file.chunks.append(script_chunk)
+        chunky_file.add_chunk(script_chunk)
 
     return chunky_file
 
@@ -296,14 +296,12 @@ def main():
         result_chunky_file = parse_and_assemble(script_file, opcode_list, args.verbose)
 
     # Generate chunky file XML
-    chunky_file_xml = chunkyfilexml.chunky_file_to_xml(result_chunky_file, build_dir)
-
     if output_xml_path:
         logger.debug("Writing XML file: %s", output_xml_path)
         with open(output_xml_path, "w") as output_xml_file:
-            output_xml_file.write(chunky_file_xml)
+            chunkyfilexml.write_chunky_file_xml(result_chunky_file, output_xml_file, build_dir)
     else:
-        print(chunky_file_xml)
+        print(chunkyfilexml.chunky_file_to_xml(result_chunky_file, build_dir))
 
 
 if __name__ == "__main__":
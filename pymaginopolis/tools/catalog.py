@@ -0,0 +1,58 @@
+import argparse
+import csv
+import logging
+
+import pymaginopolis.chunkyfile.batch as batch
+import pymaginopolis.tools.util as scriptutils
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="List the chunks in every chunky file in a directory")
+    scriptutils.add_default_args(parser, "catalog")
+    parser.add_argument("directory", type=scriptutils.directory_path, help="Directory containing chunky files")
+    parser.add_argument("--output", type=str, help="CSV file to write the list of chunks to", default=None)
+    parser.add_argument("--workers", type=int, help="Number of worker processes. Defaults to the number of CPUs.",
+                        default=None)
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = parse_args()
+    scriptutils.configure_logging(args)
+
+    logger = logging.getLogger(__name__)
+
+    paths = batch.find_chunky_files(args.directory)
+    logger.info("Found %d chunky files in %s", len(paths), args.directory)
+
+    results = batch.load_many(paths, workers=args.workers)
+
+    for result in results:
+        if result.ok:
+            table = result.result
+            print(f"{result.path}: {table.file_type} - {len(table)} chunks, {sum(table.sizes)} bytes")
+        else:
+            logger.error("Failed to load %s: %s", result.path, result.error)
+
+    if args.output:
+        with open(args.output, "w", newline="") as output_file:
+            output_csv = csv.writer(output_file)
+            output_csv.writerow(["file", "tag", "number", "name", "flags", "size", "children"])
+            for result in results:
+                if not result.ok:
+                    continue
+                table = result.result
+                for index in range(0, len(table)):
+                    chunk_id = table.chunk_id(index)
+                    number_of_children = table.child_starts[index + 1] - table.child_starts[index]
+                    output_csv.writerow([result.path, chunk_id.tag, chunk_id.number, table.names.get(index, ""),
+                                         table.flags[index], table.sizes[index], number_of_children])
+
+    failed = [r for r in results if not r.ok]
+    if failed:
+        logger.warning("%d of %d files could not be loaded", len(failed), len(results))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,12 @@
 import argparse
 import logging
 import pathlib
+import shutil
+import sys
 
 import pymaginopolis.chunkyfile.loader as loader
 import pymaginopolis.tools.util as scriptutils
-from pymaginopolis.chunkyfile.chunkxml import chunky_file_to_xml
+from pymaginopolis.chunkyfile.chunkxml import write_chunky_file_xml
 
 
 def parse_args():
@@ -13,8 +15,16 @@ def parse_args():
     parser.add_argument("input", type=scriptutils.file_path, help="Chunky file")
     parser.add_argument("output", help="XML file")
     parser.add_argument("--stdout", action="store_true", default=False, help="Print XML to stdout")
-    parser.add_argument("--chunk-data-dir", type=scriptutils.directory_path, help="Directory to write chunk data to",
-                        default=None)
+    chunk_data_group = parser.add_mutually_exclusive_group()
+    chunk_data_group.add_argument("--chunk-data-dir", type=scriptutils.directory_path,
+                                  help="Directory to write chunk data to", default=None)
+    chunk_data_group.add_argument("--sidecar", help="File to pack all chunk data into", default=None)
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="Number of threads to write chunk data files with. Helps on slow or network storage.")
+    parser.add_argument("--decompress", action="store_true", default=False,
+                        help="Write the decompressed data of compressed chunks")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Number of processes to decompress chunks with (default: number of CPUs)")
     args = parser.parse_args()
     return args
 
@@ -35,13 +45,13 @@ def main():
         this_file = loader.load_from_file(movie_file)
         output_file_path = pathlib.Path(args.output).absolute()
 
-        this_file_xml = chunky_file_to_xml(this_file, chunk_data_dir)
-
         with open(output_file_path, "w") as outfile:
-            outfile.write(this_file_xml)
+            write_chunky_file_xml(this_file, outfile, chunk_data_dir, decompress=args.decompress,
+                                  workers=args.workers, sidecar_path=args.sidecar, jobs=args.jobs)
 
         if args.stdout:
-            print(this_file_xml)
+            with open(output_file_path, "r") as outfile:
+                shutil.copyfileobj(outfile, sys.stdout)
 
 
 if __name__ == "__main__":
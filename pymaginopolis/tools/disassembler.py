@@ -1,5 +1,4 @@
 import argparse
-import io
 import logging
 
 import pymaginopolis.chunkyfile.loader as loader
@@ -39,7 +38,7 @@ def main():
             fmt = formatter.TextScriptFormatter()
 
             for c in script_chunks:
-                script = disassembler.disassemble_script(io.BytesIO(c.decoded_data))
+                script = this_chunky_file.decode(c.chunk_id, disassembler.disassemble_script_data)
                 print(fmt.format_script(script, chunk_id=c.chunk_id, chunk_name=c.name, file_name=filename))
 
         if len(string_table_chunks) > 0:
@@ -47,7 +46,7 @@ def main():
                 logger.info(f"Dumping string table: {c.chunk_id} {c.name}")
 
                 try:
-                    strings = stringtable.StringTable.from_buffer(c.decoded_data)
+                    strings = this_chunky_file.decode(c.chunk_id, stringtable.StringTable.from_buffer)
 
                     for k, v in strings.items():
                         logger.info(f"    0x{k:x} - {v}")
@@ -1,6 +1,11 @@
 import argparse
+import contextlib
 import logging
+import os
+import shutil
+import sys
 
+import pymaginopolis.chunkyfile.codecs as codecs
 import pymaginopolis.chunkyfile.loader as loader
 import pymaginopolis.chunkyfile.model as model
 import pymaginopolis.chunkyfile.writer as writer
@@ -11,16 +16,36 @@ logger = logging.getLogger("xml2chk")
 
 # sentinel value used to indicate empty file
 EMPTY_FILE = "EmpT"
+# output file name used to write to stdout
+STDOUT = "-"
 
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Generate/update CHK files from XML")
     add_default_args(parser, "xml2chk")
-    parser.add_argument("output", type=str, help="Chunky file to create")
+    parser.add_argument("output", type=str, help="Chunky file to create, or - to write to stdout")
     parser.add_argument("input", type=file_path, help="XML files containing chunk definitions", nargs="+")
     parser.add_argument("--template", type=file_path, help="Modify chunks in an existing chunky file")
+    parser.add_argument("--compress", choices=["kcdc", "kcd2"], help="Compress chunks that are not already compressed")
+    parser.add_argument("--compress-level", choices=["fast", "default", "max"], default="default",
+                        help="Compression level")
+    parser.add_argument("--incremental", action="store_true", default=False,
+                        help="Only write new and modified chunks, leaving the rest of the template in place. "
+                             "If the output is the template file, it is updated in place.")
+    parser.add_argument("--jobs", type=int, default=None,
+                        help="Memory map the output and copy chunk data into it with this many threads")
+    parser.add_argument("--deduplicate", action="store_true", default=False,
+                        help="Store the data of chunks with identical data once")
 
     args = parser.parse_args()
+    if args.incremental and not args.template:
+        parser.error("--incremental requires --template")
+    if args.incremental and args.output == STDOUT:
+        parser.error("--incremental can't write to stdout")
+    if args.jobs and (args.incremental or args.output == STDOUT):
+        parser.error("--jobs can't be used with --incremental or when writing to stdout")
+    if args.deduplicate and args.incremental:
+        parser.error("--deduplicate can't be used with --incremental")
     return args
 
 
@@ -28,11 +53,19 @@ def main():
     args = parse_args()
     configure_logging(args)
 
+    # Chunk data is read from the template when it is needed, and unchanged chunk data is copied straight from the
+    # template to the output. This isn't possible if the output replaces the template.
+    overwrite_template = (args.template and not args.incremental and args.output != STDOUT
+                          and os.path.exists(args.output) and os.path.samefile(args.output, args.template))
+
     if args.template:
         logger.info("Loading template file: %s" % args.template.absolute())
         # Load existing chunky file as a template
-        with open(args.template, "rb") as template_file:
-            chunky_file = loader.load_from_file(template_file)
+        if overwrite_template:
+            with open(args.template, "rb") as template_file:
+                chunky_file = loader.load_from_file(template_file)
+        else:
+            chunky_file = loader.load_from_path(args.template, lazy=True)
     else:
         # Create an empty chunky file
         chunky_file = model.ChunkyFile(model.Endianness.LittleEndian, model.CharacterSet.ANSI, file_type=EMPTY_FILE)
@@ -41,10 +74,52 @@ def main():
         logger.info("Processing: %s" % input_file)
         xml_to_chunky_file(chunky_file, input_file)
 
-    logger.info("Generating: %s" % args.output)
-    with open(args.output, "wb") as output_file:
-        writer.write_to_file(chunky_file, output_file)
+    if args.compress:
+        compression_type = codecs.CompressionType[args.compress.upper()]
+        compression_level = codecs.CompressionLevel[args.compress_level.capitalize()]
+        logger.info("Compressing chunks: %s, level %s" % (compression_type.name, compression_level.name))
+
+        uncompressed_size = 0
+        compressed_size = 0
+        for chunk in chunky_file.chunks:
+            if not chunk.flags & model.ChunkFlags.Compressed:
+                uncompressed_size += len(chunk.raw_data)
+                chunk.set_data(chunk.raw_data, compress=compression_type, level=compression_level)
+                compressed_size += len(chunk.raw_data)
+        logger.info("Compressed 0x%x bytes of chunk data to 0x%x bytes" % (uncompressed_size, compressed_size))
+
+    if args.incremental:
+        if not os.path.exists(args.output) or not os.path.samefile(args.output, args.template):
+            logger.info("Copying template to: %s" % args.output)
+            shutil.copyfile(args.template, args.output)
+
+        logger.info("Updating: %s" % args.output)
+        with open(args.output, "r+b") as output_file:
+            bytes_written = writer.write_incremental(chunky_file, output_file)
+        logger.info("Wrote 0x%x bytes" % bytes_written)
+    else:
+        logger.info("Generating: %s" % args.output)
+        if args.output == STDOUT:
+            output_context = contextlib.nullcontext(sys.stdout.buffer)
+        else:
+            # The output needs to be readable to memory map it
+            output_context = open(args.output, "w+b" if args.jobs else "wb")
+        if args.template and not overwrite_template:
+            template_context = open(args.template, "rb")
+        else:
+            template_context = contextlib.nullcontext()
+
+        with output_context as output_file, template_context as template_file:
+            if args.jobs:
+                bytes_saved = writer.write_mapped(chunky_file, output_file, template=template_file, jobs=args.jobs,
+                                                  deduplicate=args.deduplicate)
+            else:
+                bytes_saved = writer.write_to_file(chunky_file, output_file, template=template_file,
+                                                   deduplicate=args.deduplicate)
+        if args.deduplicate:
+            logger.info("Saved 0x%x bytes by storing duplicate chunk data once" % bytes_saved)
 
+    chunky_file.close()
     logger.info("Complete")
 
 
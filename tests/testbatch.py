@@ -0,0 +1,56 @@
+import pathlib
+import unittest
+
+import pymaginopolis.chunkyfile.batch as batch
+import pymaginopolis.chunkyfile.codecs as codecs
+import pymaginopolis.chunkyfile.model as filemodel
+
+
+class BatchLoaderTests(unittest.TestCase):
+
+    @staticmethod
+    def get_data_dir():
+        return pathlib.Path(__file__).parent / "data"
+
+    def test_load_many(self):
+        """ Test loading several files in worker processes, with one file that can't be loaded """
+        movie_file_path = self.get_data_dir() / "unittest.3mm"
+        missing_file_path = self.get_data_dir() / "missing.3mm"
+
+        for workers in [1, 2]:
+            results = batch.load_many([movie_file_path, missing_file_path, movie_file_path], workers=workers)
+            self.assertEqual([r.ok for r in results], [True, False, True])
+            self.assertEqual(results[1].path, str(missing_file_path))
+
+            table = results[0].result
+            self.assertEqual(table.file_type, "SOC ")
+            self.assertEqual(len(table), 12)
+            self.assertIn(filemodel.ChunkId("MVIE", 0), [table.chunk_id(i) for i in range(0, len(table))])
+
+    def test_load_many_full(self):
+        """ Test loading whole chunky files in worker processes """
+        movie_file_path = self.get_data_dir() / "unittest.3mm"
+
+        results = batch.load_many([movie_file_path], workers=2, full=True)
+        chunky_file = results[0].result
+        self.assertEqual(len(chunky_file[filemodel.ChunkId("THUM", 0)].raw_data), 12016)
+
+    def test_decompress_many(self):
+        """ Test decompressing chunk data in worker processes """
+        decompressed = [(b"chunk %d " % i) * (i + 1) for i in range(0, 20)]
+        compressed = [codecs.compress(data, codecs.CompressionType.KCD2) for data in decompressed]
+
+        for workers in [1, 2]:
+            results = batch.decompress_many(compressed, workers=workers, max_pending=3)
+            self.assertEqual([bytes(r) for r in results], decompressed)
+
+            # Errors are returned in place of the data instead of stopping the other chunks from being decompressed
+            results = list(batch.decompress_many([compressed[0], b'KCD2corrupt', compressed[1]], workers=workers,
+                                                 catch_errors=True))
+            self.assertEqual(bytes(results[0]), decompressed[0])
+            self.assertIsInstance(results[1], codecs.CompressionException)
+            self.assertEqual(bytes(results[2]), decompressed[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
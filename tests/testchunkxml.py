@@ -0,0 +1,194 @@
+import base64
+import io
+import pathlib
+import tempfile
+import unittest
+from unittest import mock
+from xml.etree import ElementTree
+
+import pymaginopolis.chunkyfile.chunkxml as chunkxml
+import pymaginopolis.chunkyfile.codecs as codecs
+import pymaginopolis.chunkyfile.model as filemodel
+
+STRING_TABLE_DATA = b'string table ' * 40
+SCRIPT_DATA = b'script ' * 40
+
+
+def make_test_file():
+    """ Create a chunky file with two compressed chunks and an uncompressed chunk """
+    gst = filemodel.Chunk("GST ", 1, name="strings")
+    gst.set_data(STRING_TABLE_DATA, compress=codecs.CompressionType.KCDC)
+    glsc = filemodel.Chunk("GLSC", 2)
+    glsc.set_data(SCRIPT_DATA, compress=codecs.CompressionType.KCD2)
+    mvie = filemodel.Chunk("MVIE", 0, flags=filemodel.ChunkFlags.Loner, data=b'movie',
+                           children=[filemodel.ChunkChild(0, gst.chunk_id), filemodel.ChunkChild(1, glsc.chunk_id)])
+    return filemodel.ChunkyFile(filemodel.Endianness.LittleEndian, filemodel.CharacterSet.ANSI, file_type="SOC ",
+                                chunks=[mvie, gst, glsc])
+
+
+class ChunkXmlTests(unittest.TestCase):
+    def test_to_xml(self):
+        """ Test that compressed chunks are written compressed by default """
+        chunky_file = make_test_file()
+        root = ElementTree.fromstring(chunkxml.chunky_file_to_xml(chunky_file))
+
+        chunks = root.findall("Chunk")
+        self.assertEqual([c.get("tag") for c in chunks], ["MVIE", "GST ", "GLSC"])
+        self.assertEqual(chunks[1].get("compressed"), "true")
+        self.assertEqual(base64.b64decode(chunks[1].find("Data").text),
+                         chunky_file[("GST ", 1)].encoded_data)
+        self.assertEqual(len(chunks[0].findall("Child")), 2)
+
+    def test_to_xml_decompress(self):
+        """ Test writing decompressed chunk data to files """
+        chunky_file = make_test_file()
+        with tempfile.TemporaryDirectory() as temp_dir:
+            for workers in [1, 2]:
+                root = ElementTree.fromstring(chunkxml.chunky_file_to_xml(chunky_file, temp_dir, decompress=True,
+                                                                          workers=workers))
+                chunks = root.findall("Chunk")
+                self.assertIsNone(chunks[1].get("compressed"))
+                self.assertEqual(pathlib.Path(chunks[1].find("File").text).read_bytes(), STRING_TABLE_DATA)
+                self.assertEqual(pathlib.Path(chunks[2].find("File").text).read_bytes(), SCRIPT_DATA)
+                self.assertEqual(pathlib.Path(chunks[0].find("File").text).read_bytes(), b'movie')
+
+    def test_to_xml_decompress_error(self):
+        """ Test that chunks that can't be decompressed are written compressed """
+        chunky_file = make_test_file()
+        corrupt_data = chunky_file[("GST ", 1)].encoded_data[:12]
+        chunky_file[("GST ", 1)].raw_data = corrupt_data
+        for workers in [1, 2]:
+            with self.assertLogs(chunkxml.__name__, level="WARNING"):
+                root = ElementTree.fromstring(chunkxml.chunky_file_to_xml(chunky_file, decompress=True,
+                                                                          workers=workers))
+            chunks = root.findall("Chunk")
+            self.assertEqual(chunks[1].get("compressed"), "true")
+            self.assertEqual(base64.b64decode(chunks[1].find("Data").text), corrupt_data)
+            self.assertIsNone(chunks[2].get("compressed"))
+            self.assertEqual(base64.b64decode(chunks[2].find("Data").text), SCRIPT_DATA)
+
+    def test_to_xml_decompress_write_error(self):
+        """ Test that the decompression workers are shut down if writing the XML fails """
+        generators = []
+        real_decompress_many = chunkxml.batch.decompress_many
+
+        def record_decompress_many(*args, **kwargs):
+            generators.append(real_decompress_many(*args, **kwargs))
+            return generators[-1]
+
+        class FailingOutput(io.StringIO):
+            def write(self, text):
+                if 'tag="GLSC"' in text:
+                    raise OSError("disk full")
+                return super().write(text)
+
+        with mock.patch.object(chunkxml.batch, "decompress_many", record_decompress_many):
+            with self.assertRaises(OSError):
+                chunkxml.write_chunky_file_xml(make_test_file(), FailingOutput(), decompress=True, workers=2)
+        self.assertIsNone(generators[0].gi_frame)
+
+    def test_write_xml(self):
+        """ Test that the streaming writer produces indented XML that can be parsed """
+        chunky_file = make_test_file()
+        chunky_file[("MVIE", 0)].name = 'Movie & "friends" <1>'
+        output = io.StringIO()
+        chunkxml.write_chunky_file_xml(chunky_file, output)
+
+        lines = output.getvalue().splitlines()
+        self.assertEqual(lines[0], '<?xml version="1.0" ?>')
+        self.assertEqual(lines[1], '<ChunkyFile type="SOC " endianness="LittleEndian" charset="ANSI">')
+        self.assertEqual(lines[2], '\t<Chunk tag="MVIE" number="0" name="Movie &amp; &quot;friends&quot; &lt;1&gt;" '
+                                   'loner="true">')
+        self.assertEqual(lines[3], '\t\t<Child chid="0" tag="GST " number="1"/>')
+        self.assertEqual(lines[5], '\t\t<Data>bW92aWU=</Data>')
+        self.assertEqual(lines[-1], '</ChunkyFile>')
+
+        root = ElementTree.fromstring(output.getvalue())
+        self.assertEqual(root.find("Chunk").get("name"), 'Movie & "friends" <1>')
+
+    def test_chunk_data_files(self):
+        """ Test that writing chunk data files with a pool of threads gives the same result """
+        chunky_file = make_test_file()
+        with tempfile.TemporaryDirectory() as temp_dir:
+            results = []
+            for jobs in [1, 4]:
+                xml = chunkxml.chunky_file_to_xml(chunky_file, temp_dir, jobs=jobs)
+                files = {p.name: p.read_bytes() for p in pathlib.Path(temp_dir).iterdir()}
+                results.append((xml, files))
+
+            self.assertEqual(results[0], results[1])
+            self.assertEqual(results[0][1]["0.mvie"], b'movie')
+            self.assertEqual(results[0][1]["1.gst.kcdc"], chunky_file[("GST ", 1)].encoded_data)
+
+    def test_chunk_data_file_errors(self):
+        """ Test that errors writing chunk data files are raised """
+        with tempfile.TemporaryDirectory() as temp_dir:
+            file_writer = chunkxml.ChunkDataFileWriter(jobs=2)
+            file_writer.write(pathlib.Path(temp_dir) / "missing" / "1.gst", b'data')
+            with self.assertRaises(OSError):
+                file_writer.close()
+
+    def test_from_xml(self):
+        """ Test that a chunky file survives a round trip through XML """
+        chunky_file = make_test_file()
+        with tempfile.TemporaryDirectory() as temp_dir:
+            xml_path = pathlib.Path(temp_dir) / "chunks.xml"
+            xml_path.write_text(chunkxml.chunky_file_to_xml(chunky_file))
+
+            new_file = filemodel.ChunkyFile(filemodel.Endianness.LittleEndian, filemodel.CharacterSet.ANSI,
+                                            file_type=chunkxml.EMPTY_FILE)
+            chunkxml.xml_to_chunky_file(new_file, str(xml_path))
+
+        self.assertEqual(new_file.file_type, "SOC ")
+        self.assertEqual([c.chunk_id for c in new_file.chunks], [c.chunk_id for c in chunky_file.chunks])
+        for chunk in chunky_file.chunks:
+            new_chunk = new_file[chunk.chunk_id]
+            self.assertEqual(new_chunk.name, chunk.name)
+            self.assertEqual(new_chunk.flags, chunk.flags)
+            self.assertEqual(new_chunk.children, chunk.children)
+            self.assertEqual(new_chunk.decoded_data, chunk.decoded_data)
+
+    def test_from_xml_wrong_root(self):
+        """ Test that XML files that don't describe a chunky file are rejected """
+        new_file = filemodel.ChunkyFile(filemodel.Endianness.LittleEndian, filemodel.CharacterSet.ANSI)
+        with self.assertRaises(Exception):
+            chunkxml.xml_to_chunky_file(new_file, io.BytesIO(b'<Movie><Chunk tag="MVIE" number="0"/></Movie>'))
+        self.assertEqual(len(new_file.chunks), 0)
+
+    def test_sidecar(self):
+        """ Test packing chunk data into a sidecar file and loading it back """
+        chunky_file = make_test_file()
+        with tempfile.TemporaryDirectory() as temp_dir:
+            xml_path = pathlib.Path(temp_dir) / "chunks.xml"
+            sidecar_path = pathlib.Path(temp_dir) / "chunks.bin"
+            # The sidecar path is absolute when the XML isn't written to a file
+            xml = chunkxml.chunky_file_to_xml(chunky_file, sidecar_path=sidecar_path)
+            self.assertEqual(ElementTree.fromstring(xml).get("sidecar"), str(sidecar_path.absolute()))
+
+            # Otherwise it is relative to the XML file
+            with open(xml_path, "w") as xml_file:
+                chunkxml.write_chunky_file_xml(chunky_file, xml_file, sidecar_path=sidecar_path)
+
+            root = ElementTree.parse(str(xml_path)).getroot()
+            self.assertEqual(root.get("sidecar"), "chunks.bin")
+            self.assertIsNone(root.find("Chunk").find("Data"))
+            blob = root.findall("Chunk")[1].find("Blob")
+            self.assertEqual(int(blob.get("size")), len(chunky_file[("GST ", 1)].encoded_data))
+
+            # Closing the chunky file closes the sidecar mapping, so the sidecar file can be deleted
+            with filemodel.ChunkyFile(filemodel.Endianness.LittleEndian, filemodel.CharacterSet.ANSI,
+                                      file_type=chunkxml.EMPTY_FILE) as new_file:
+                chunkxml.xml_to_chunky_file(new_file, str(xml_path))
+
+                for chunk in chunky_file.chunks:
+                    new_chunk = new_file[chunk.chunk_id]
+                    self.assertIsInstance(new_chunk.raw_data, memoryview)
+                    self.assertEqual(new_chunk.raw_data, chunk.raw_data)
+                    self.assertEqual(new_chunk.decoded_data, chunk.decoded_data)
+                sidecar_mapping = new_file[("GST ", 1)].raw_data.obj
+
+            self.assertTrue(sidecar_mapping.closed)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,184 @@
+import random
+import unittest
+
+import pymaginopolis.chunkyfile.codecs as codecs
+import pymaginopolis.chunkyfile.model as filemodel
+
+
+def make_compressed(decompressed_size, tokens, magic=b'KCDC'):
+    """
+    Build KCDC or KCD2 data from a list of tokens
+    :param decompressed_size: size to put in the header
+    :param tokens: list of ("literal", byte), ("literals", bytes) for KCD2, or ("match", offset, length)
+    :param magic: compression type
+    """
+    bit_writer = codecs.BitWriter()
+    for token in tokens:
+        if token[0] == "literal":
+            bit_writer.write(0, 1)
+            bit_writer.write(token[1], 8)
+        elif token[0] == "literals":
+            bit_writer.write(0, 1)
+            codecs._write_length(bit_writer, len(token[1]))
+            for b in token[1]:
+                bit_writer.write(b, 8)
+        else:
+            _, offset, length = token
+            prefix, prefix_size, offset_bits, min_offset = [c for c in codecs.KCDC_OFFSET_CLASSES if c[3] <= offset][-1]
+            bit_writer.write(prefix, prefix_size)
+            bit_writer.write(offset - min_offset, offset_bits)
+            codecs._write_length(bit_writer, length - (2 if min_offset == 0x1241 else 1))
+
+    # End of stream
+    bit_writer.write(0b1111, 4)
+    bit_writer.write(codecs.KCDC_END_OF_STREAM, 20)
+    header = codecs.COMPRESSION_HEADER.pack(magic, decompressed_size, 0)
+    return header + bit_writer.flush() + codecs.COMPRESSION_TAIL
+
+
+def make_kcdc(decompressed_size, tokens):
+    return make_compressed(decompressed_size, tokens, b'KCDC')
+
+
+def make_kcd2(decompressed_size, tokens):
+    return make_compressed(decompressed_size, tokens, b'KCD2')
+
+
+class KCDCTests(unittest.TestCase):
+    def test_decompress_literals_and_matches(self):
+        """ Test decompressing literals, an overlapping match and a match with a long offset """
+        tokens = [("literal", b) for b in b'ab'] + [("match", 2, 6)]
+        tokens += [("literal", b) for b in bytes(range(0, 256)) * 20]
+        tokens += [("match", 5120, 10), ("match", 100, 3)]
+        expected = b'abababab' + bytes(range(0, 256)) * 20
+        expected += expected[-5120:-5120 + 10]
+        expected += expected[-100:-100 + 3]
+
+        compressed = make_kcdc(len(expected), tokens)
+        self.assertEqual(codecs.identify_compression(compressed), codecs.CompressionType.KCDC)
+        self.assertEqual(codecs.decompress(compressed), expected)
+
+        # Decompress into an existing buffer
+        output = bytearray(len(expected) + 10)
+        codecs.decompress(compressed, memoryview(output))
+        self.assertEqual(output[0:len(expected)], expected)
+
+    def test_decoded_data(self):
+        """ Test that compressed chunks are decompressed """
+        compressed = make_kcdc(4, [("literal", 0x41), ("match", 1, 3)])
+        chunk = filemodel.Chunk("MBMP", 1, flags=filemodel.ChunkFlags.Compressed, data=compressed)
+        self.assertEqual(chunk.decoded_data, b'AAAA')
+        self.assertEqual(chunk.encoded_data, compressed)
+
+    def test_corrupt_data(self):
+        """ Test that bad compressed data raises an exception """
+        # Too much output
+        with self.assertRaises(codecs.CompressionException):
+            codecs.decompress(make_kcdc(2, [("literal", 0x41)] * 3))
+
+        # Too little output
+        with self.assertRaises(codecs.CompressionException):
+            codecs.decompress(make_kcdc(4, [("literal", 0x41)] * 3))
+
+        # Match before the start of the data
+        with self.assertRaises(codecs.CompressionException):
+            codecs.decompress(make_kcdc(4, [("literal", 0x41), ("match", 2, 3)]))
+
+        # Truncated
+        with self.assertRaises(codecs.CompressionException):
+            codecs.decompress(make_kcdc(4, [("literal", 0x41), ("match", 1, 3)])[0:10])
+
+
+class KCD2Tests(unittest.TestCase):
+    def test_decompress_literal_runs_and_matches(self):
+        """ Test decompressing runs of literals and matches """
+        literals = bytes(range(0, 256)) * 40
+        tokens = [("literals", b'ab'), ("match", 2, 6), ("literals", literals), ("match", 5120, 10),
+                  ("literals", b'z'), ("match", 100, 3)]
+        expected = b'abababab' + literals
+        expected += expected[-5120:-5120 + 10] + b'z'
+        expected += expected[-100:-100 + 3]
+
+        compressed = make_kcd2(len(expected), tokens)
+        self.assertEqual(codecs.identify_compression(compressed), codecs.CompressionType.KCD2)
+        self.assertEqual(codecs.decompress(compressed), expected)
+
+        # Decompress into the middle of an existing buffer
+        output = bytearray(len(expected) + 20)
+        codecs.decompress(compressed, memoryview(output)[10:])
+        self.assertEqual(output[10:10 + len(expected)], expected)
+
+    def test_decoded_data(self):
+        """ Test that KCD2 compressed chunks are decompressed """
+        compressed = make_kcd2(6, [("literals", b'AB'), ("match", 2, 4)])
+        chunk = filemodel.Chunk("WAVE", 1, flags=filemodel.ChunkFlags.Compressed, data=compressed)
+        self.assertEqual(chunk.decoded_data, b'ABABAB')
+
+    def test_corrupt_data(self):
+        """ Test that bad compressed data raises an exception """
+        # Literal run longer than the output
+        with self.assertRaises(codecs.CompressionException):
+            codecs.decompress(make_kcd2(2, [("literals", b'ABC')]))
+
+        # Literal run truncated
+        with self.assertRaises(codecs.CompressionException):
+            codecs.decompress(make_kcd2(100, [("literals", b'A' * 100)])[0:40])
+
+        # Decompressed size in the header that the data is far too small for
+        header = codecs.COMPRESSION_HEADER.pack(b'KCD2', 0xFFFFFFFF, 0)
+        with self.assertRaises(codecs.CompressionException):
+            codecs.decompress(header + b'\x00\x00\x00\x00')
+
+
+class CompressionTests(unittest.TestCase):
+    # Text, a long run, a repeated pattern with a long offset and some bytes that don't compress
+    TEST_DATA = (b"3D Movie Maker " * 50) + bytes(3000) + bytes(range(0, 256)) * 30 + b"\x01\x7f\xfe"
+
+    def test_round_trip(self):
+        """ Test that compressed data decompresses to the original data for each type and level """
+        for compression_type in [codecs.CompressionType.KCDC, codecs.CompressionType.KCD2]:
+            for level in codecs.CompressionLevel:
+                for data in [self.TEST_DATA, b'', b'A', b'ABABAB']:
+                    compressed = codecs.compress(data, compression_type, level)
+                    self.assertEqual(codecs.identify_compression(compressed), compression_type)
+                    self.assertEqual(codecs.decompress(compressed), data)
+
+                compressed = codecs.compress(self.TEST_DATA, compression_type, level)
+                self.assertLess(len(compressed), len(self.TEST_DATA) // 4)
+
+                # Data that compresses extremely well is still within the size limit
+                long_run = bytes(0x100000)
+                self.assertEqual(codecs.decompress(codecs.compress(long_run, compression_type, level)), long_run)
+
+    def test_corrupt_data(self):
+        """ Test that randomly corrupted and truncated data only raises CompressionException """
+        rng = random.Random(0)
+        for compression_type in [codecs.CompressionType.KCDC, codecs.CompressionType.KCD2]:
+            compressed = codecs.compress(self.TEST_DATA, compression_type)
+            for _ in range(0, 1000):
+                corrupt_data = bytearray(compressed)
+                for _ in range(0, rng.randint(1, 8)):
+                    corrupt_data[rng.randrange(codecs.COMPRESSION_HEADER_SIZE, len(corrupt_data))] = rng.randrange(256)
+                if rng.random() < 0.3:
+                    corrupt_data = corrupt_data[:rng.randrange(codecs.COMPRESSION_HEADER_SIZE, len(corrupt_data))]
+                try:
+                    codecs.decompress(bytes(corrupt_data))
+                except codecs.CompressionException:
+                    pass
+
+    def test_set_data(self):
+        """ Test compressing chunk data """
+        chunk = filemodel.Chunk("GST ", 1)
+        chunk.set_data(self.TEST_DATA, compress=codecs.CompressionType.KCD2)
+        self.assertTrue(chunk.flags & filemodel.ChunkFlags.Compressed)
+        self.assertLess(len(chunk.encoded_data), len(self.TEST_DATA))
+        self.assertEqual(chunk.decoded_data, self.TEST_DATA)
+
+        # Data that gets bigger when compressed is stored uncompressed
+        chunk.set_data(b'ABC', compress=codecs.CompressionType.KCDC)
+        self.assertFalse(chunk.flags & filemodel.ChunkFlags.Compressed)
+        self.assertEqual(chunk.raw_data, b'ABC')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,6 +4,8 @@ import pymaginopolis.chunkyfile.loader as loader
 import pymaginopolis.chunkyfile.model as filemodel
 import logging
 import os
+import tempfile
+from unittest import mock
 
 CHUNKY_FILE_EXTENSIONS = {".3mm", ".3th", ".3cn",  # 3DMM
                           ".nmm", ".nth", ".1mm",  # Nickelodeon 3DMM
@@ -47,6 +49,123 @@ class ChunkyLoaderTests(unittest.TestCase):
             self.assertEqual(len(tmpl_chunk.children), 1)
             self.assertEqual(len(mvie_chunk.children), 3)
 
+    def test_load_mmap(self):
+        """ Test loading a chunky file with chunk data backed by a memory mapping """
+        movie_file_path = self.get_data_dir() / "unittest.3mm"
+
+        with open(movie_file_path, "rb") as movie_file:
+            expected_file = loader.load_from_file(movie_file)
+
+        with loader.load_from_path(movie_file_path, mmap=True) as mapped_file:
+            self.assertEqual(len(mapped_file.chunks), len(expected_file.chunks))
+            for expected_chunk, mapped_chunk in zip(expected_file.chunks, mapped_file.chunks):
+                self.assertEqual(expected_chunk.chunk_id, mapped_chunk.chunk_id)
+                self.assertIsInstance(mapped_chunk.raw_data, memoryview)
+                self.assertEqual(expected_chunk.raw_data, mapped_chunk.raw_data)
+
+            thum_chunk = mapped_file[filemodel.ChunkId("THUM", 0)]
+
+        # Chunk data is no longer accessible once the file is closed
+        with self.assertRaises(ValueError):
+            bytes(thum_chunk.raw_data)
+
+        # The mapping is closed even if some chunks have not been read
+        mapped_file = loader.load_from_path(movie_file_path, mmap=True, lazy=True)
+        self.assertEqual(bytes(mapped_file[("THUM", 0)].raw_data), bytes(expected_file[("THUM", 0)].raw_data))
+        mapping = mapped_file[("THUM", 0)].raw_data.obj
+        mapped_file.close()
+        self.assertTrue(mapping.closed)
+
+    def test_load_mmap_bad_file(self):
+        """ Test that the mapping is closed if the file can't be loaded """
+        mappings = []
+        real_mmap = loader.mmapfile.mmap
+
+        def record_mmap(*args, **kwargs):
+            mappings.append(real_mmap(*args, **kwargs))
+            return mappings[-1]
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            bad_file_path = pathlib.Path(temp_dir) / "bad.3mm"
+            bad_file_path.write_bytes(b'NOPE' + bytes(loader.FILE_HEADER_SIZE))
+            with mock.patch.object(loader.mmapfile, "mmap", record_mmap):
+                with self.assertRaises(loader.FileParseException):
+                    loader.load_from_path(bad_file_path, mmap=True)
+        self.assertEqual(len(mappings), 1)
+        self.assertTrue(mappings[0].closed)
+
+    def test_load_lazy(self):
+        """ Test loading only the index of a chunky file and reading chunk data on demand """
+        movie_file_path = self.get_data_dir() / "unittest.3mm"
+
+        with open(movie_file_path, "rb") as movie_file:
+            expected_file = loader.load_from_file(movie_file)
+
+        with loader.load_from_path(movie_file_path, lazy=True) as lazy_file:
+            self.assertFalse(any(c.is_loaded for c in lazy_file.chunks))
+
+            thum_chunk = lazy_file[filemodel.ChunkId("THUM", 0)]
+            self.assertEqual(thum_chunk.data_size, 12016)
+            self.assertFalse(thum_chunk.is_loaded)
+
+            for expected_chunk, lazy_chunk in zip(expected_file.chunks, lazy_file.chunks):
+                self.assertEqual(expected_chunk.raw_data, lazy_chunk.raw_data)
+                self.assertTrue(lazy_chunk.is_loaded)
+
+    def test_load_chunk_table(self):
+        """ Test loading the index of a chunky file into a ChunkTable """
+        movie_file_path = self.get_data_dir() / "unittest.3mm"
+
+        with open(movie_file_path, "rb") as movie_file:
+            expected_file = loader.load_from_file(movie_file)
+
+            movie_file.seek(0)
+            table = loader.load_chunk_table(movie_file)
+            self.assertEqual(table.file_type, "SOC ")
+            self.assertEqual(len(table), len(expected_file.chunks))
+
+            for index, expected_chunk in enumerate(expected_file.chunks):
+                self.assertEqual(table.chunk_id(index), expected_chunk.chunk_id)
+
+                table_chunk = table[index]
+                self.assertEqual(table_chunk.chunk_id, expected_chunk.chunk_id)
+                self.assertEqual(table_chunk.name, expected_chunk.name)
+                self.assertEqual(table_chunk.flags, expected_chunk.flags)
+                self.assertEqual(table_chunk.children, expected_chunk.children)
+                self.assertEqual(table_chunk.raw_data, expected_chunk.raw_data)
+
+    def test_iter_chunk_headers(self):
+        """ Test streaming the chunk headers from the index """
+        movie_file_path = self.get_data_dir() / "unittest.3mm"
+
+        with open(movie_file_path, "rb") as movie_file:
+            expected_file = loader.load_from_file(movie_file)
+            headers = list(loader.iter_chunk_headers(movie_file))
+
+        self.assertEqual(len(headers), len(expected_file.chunks))
+        for header, expected_chunk in zip(headers, expected_file.chunks):
+            self.assertEqual(filemodel.ChunkId(header["tag"], header["number"]), expected_chunk.chunk_id)
+            self.assertEqual(header["size"], len(expected_chunk.raw_data))
+            self.assertEqual(header["flags"], expected_chunk.flags)
+            self.assertEqual(header.get("name"), expected_chunk.name)
+            self.assertEqual(tuple(filemodel.ChunkChild(c["chid"], filemodel.ChunkId(c["tag"], c["number"]))
+                                   for c in header["children"]), expected_chunk.children)
+
+    def test_plan_reads(self):
+        """ Test merging chunk data reads """
+        ranges = [(0x300, 0x10), (0x100, 0x80), (0x180, 0x20), (0x1A8, 0x10), (0x200, 0)]
+
+        # Ranges are sorted by offset and ranges that touch are merged
+        self.assertEqual(loader.plan_reads(ranges, max_gap=0),
+                         [(0x100, 0xA0), (0x1A8, 0x10), (0x200, 0), (0x300, 0x10)])
+
+        # Ranges with a small gap between them are merged
+        self.assertEqual(loader.plan_reads(ranges, max_gap=0x40), [(0x100, 0xB8), (0x200, 0), (0x300, 0x10)])
+        self.assertEqual(loader.plan_reads(ranges, max_gap=0x100), [(0x100, 0x210)])
+
+        # Reads don't grow past the maximum read size
+        self.assertEqual(loader.plan_reads(ranges, max_gap=0x100, max_read_size=0x100), [(0x100, 0x100), (0x300, 0x10)])
+
     def test_load_all_chunky_files(self):
         """ Test loading a directory of chunky files """
         logger = logging.getLogger(__name__)
@@ -0,0 +1,188 @@
+import unittest
+
+import pymaginopolis.chunkyfile.cache as cache
+import pymaginopolis.chunkyfile.codecs as codecs
+import pymaginopolis.chunkyfile.model as filemodel
+
+
+def make_test_file():
+    """ Create a small chunky file: a movie that has two string tables as children """
+    gst_one = filemodel.Chunk("GST ", 1, data=b'one')
+    gst_two = filemodel.Chunk("GST ", 2, data=b'two')
+    mvie = filemodel.Chunk("MVIE", 0, flags=filemodel.ChunkFlags.Loner, data=b'movie',
+                           children=[filemodel.ChunkChild(0, gst_one.chunk_id),
+                                     filemodel.ChunkChild(1, gst_two.chunk_id)])
+    return filemodel.ChunkyFile(filemodel.Endianness.LittleEndian, filemodel.CharacterSet.ANSI,
+                                chunks=[mvie, gst_one, gst_two])
+
+
+class ChunkyFileTests(unittest.TestCase):
+    def test_lookup(self):
+        """ Test looking up chunks by chunk ID and tag """
+        chunky_file = make_test_file()
+
+        self.assertEqual(chunky_file[filemodel.ChunkId("GST ", 1)].raw_data, b'one')
+        self.assertEqual(chunky_file[("GST ", 2)].raw_data, b'two')
+        self.assertEqual(chunky_file["MVIE"].raw_data, b'movie')
+        self.assertEqual([c.raw_data for c in chunky_file["GST"]], [b'one', b'two'])
+
+        self.assertIn(("MVIE", 0), chunky_file)
+        self.assertNotIn(("MVIE", 1), chunky_file)
+        self.assertEqual(chunky_file.get_chunks("WAVE"), [])
+        with self.assertRaises(KeyError):
+            _ = chunky_file[("GST ", 3)]
+
+    def test_add_remove_replace(self):
+        """ Test modifying the chunks in a file """
+        chunky_file = make_test_file()
+
+        # Chunk IDs must be unique
+        with self.assertRaises(ValueError):
+            chunky_file.add_chunk(filemodel.Chunk("GST ", 1))
+
+        chunky_file.add_chunk(filemodel.Chunk("GST ", 3, data=b'three'))
+        self.assertEqual(len(chunky_file["GST"]), 3)
+
+        removed_chunk = chunky_file.remove_chunk(("GST ", 1))
+        self.assertEqual(removed_chunk.raw_data, b'one')
+        self.assertNotIn(("GST ", 1), chunky_file)
+        self.assertEqual(len(chunky_file["GST"]), 2)
+
+        replaced_chunk = chunky_file.replace_chunk(filemodel.Chunk("GST ", 2, data=b'TWO'))
+        self.assertEqual(replaced_chunk.raw_data, b'two')
+        self.assertEqual(chunky_file[("GST ", 2)].raw_data, b'TWO')
+        self.assertEqual([c.chunk_id for c in chunky_file.chunks],
+                         [filemodel.ChunkId("MVIE", 0), filemodel.ChunkId("GST ", 2), filemodel.ChunkId("GST ", 3)])
+
+        chunky_file.remove_chunk(("MVIE", 0))
+        self.assertEqual(chunky_file.get_chunks("MVIE"), [])
+
+        # The list of chunks can't be changed directly
+        with self.assertRaises(AttributeError):
+            chunky_file.chunks.append(filemodel.Chunk("GST ", 4))
+
+    def test_parents_of(self):
+        """ Test finding the parents of a chunk """
+        chunky_file = make_test_file()
+        mvie_id = filemodel.ChunkId("MVIE", 0)
+        gst_id = filemodel.ChunkId("GST ", 1)
+
+        self.assertEqual([c.chunk_id for c in chunky_file.parents_of(gst_id)], [mvie_id])
+        self.assertEqual(chunky_file.parents_of(mvie_id), [])
+        self.assertEqual(chunky_file.count_parents(gst_id), 1)
+
+        # The parent index is updated when the file changes
+        chunky_file.add_chunk(filemodel.Chunk("SCEN", 0, children=[filemodel.ChunkChild(0, gst_id)]))
+        chunky_file.add_child(mvie_id, filemodel.ChunkChild(2, gst_id))
+        self.assertEqual([c.chunk_id for c in chunky_file.parents_of(gst_id)],
+                         [mvie_id, filemodel.ChunkId("SCEN", 0)])
+        self.assertEqual(chunky_file.count_parents(gst_id), 3)
+
+        # Changing a chunk's children directly also updates the parent index
+        scen_chunk = chunky_file[("SCEN", 0)]
+        scen_chunk.children = scen_chunk.children + (filemodel.ChunkChild(1, filemodel.ChunkId("GST ", 2)),)
+        self.assertEqual([c.chunk_id for c in chunky_file.parents_of(("GST ", 2))],
+                         [mvie_id, filemodel.ChunkId("SCEN", 0)])
+        self.assertEqual(chunky_file.count_parents(("GST ", 2)), 2)
+        self.assertEqual(list(chunky_file.iter_topological())[0].chunk_id, mvie_id)
+        scen_chunk.children = []
+        self.assertEqual(chunky_file.count_parents(gst_id), 2)
+
+        # The children can't be changed in place
+        with self.assertRaises(AttributeError):
+            scen_chunk.children.append(filemodel.ChunkChild(0, gst_id))
+
+    def test_descendants_of(self):
+        """ Test walking the children of a chunk """
+        chunky_file = make_test_file()
+        chunky_file.add_chunk(filemodel.Chunk("TMPL", 0))
+        chunky_file.add_child(("GST ", 1), filemodel.ChunkChild(0, filemodel.ChunkId("TMPL", 0)))
+        # References to chunks that don't exist are skipped
+        chunky_file.add_child(("GST ", 2), filemodel.ChunkChild(0, filemodel.ChunkId("WAVE", 0)))
+
+        breadth_first = [c.chunk_id for c in chunky_file.descendants_of(("MVIE", 0))]
+        self.assertEqual(breadth_first, [("GST ", 1), ("GST ", 2), ("TMPL", 0)])
+
+        depth_first = [c.chunk_id for c in chunky_file.descendants_of(("MVIE", 0), depth_first=True)]
+        self.assertEqual(depth_first, [("GST ", 1), ("TMPL", 0), ("GST ", 2)])
+
+    def test_iter_topological(self):
+        """ Test ordering chunks so that parents come before children """
+        chunky_file = make_test_file()
+        chunky_file.add_chunk(filemodel.Chunk("TMPL", 0,
+                                              children=[filemodel.ChunkChild(0, filemodel.ChunkId("MVIE", 0))]))
+
+        ordered = [c.chunk_id for c in chunky_file.iter_topological()]
+        self.assertEqual(ordered, [("TMPL", 0), ("MVIE", 0), ("GST ", 1), ("GST ", 2)])
+
+        # Cycles can't be ordered
+        chunky_file.add_child(("GST ", 1), filemodel.ChunkChild(0, filemodel.ChunkId("TMPL", 0)))
+        with self.assertRaises(ValueError):
+            list(chunky_file.iter_topological())
+
+
+class DecodedDataCacheTests(unittest.TestCase):
+    def test_decode(self):
+        """ Test that decoded chunk data is cached until the chunk data changes """
+        chunky_file = make_test_file()
+        calls = []
+
+        def decoder(data):
+            calls.append(data)
+            return bytes(data).upper()
+
+        self.assertEqual(chunky_file.decode(("GST ", 1), decoder), b'ONE')
+        self.assertEqual(chunky_file.decode(("GST ", 1), decoder), b'ONE')
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(chunky_file.decoded_cache.hits, 1)
+        self.assertEqual(chunky_file.decoded_cache.misses, 1)
+
+        # Changing the data invalidates the cached value
+        chunky_file[("GST ", 1)].raw_data = b'uno'
+        self.assertEqual(chunky_file.decode(("GST ", 1), decoder), b'UNO')
+        self.assertEqual(len(calls), 2)
+
+        # So does replacing the chunk
+        chunky_file.replace_chunk(filemodel.Chunk("GST ", 1, data=b'eins'))
+        self.assertEqual(chunky_file.decode(("GST ", 1), decoder), b'EINS')
+        self.assertEqual(len(calls), 3)
+
+        # Uncompressed data is not copied into the cache
+        self.assertEqual(chunky_file.decode(("GST ", 2)), b'two')
+        self.assertEqual(len(chunky_file.decoded_cache), 1)
+
+    def test_decode_compressed(self):
+        """ Test that decompressed data is cached """
+        chunky_file = make_test_file()
+        data = b'compressed string table ' * 20
+        chunky_file[("GST ", 2)].set_data(data, compress=codecs.CompressionType.KCDC)
+
+        self.assertEqual(chunky_file.decode(("GST ", 2)), data)
+        self.assertEqual(chunky_file.decode(("GST ", 2), bytes), data)
+        self.assertEqual(chunky_file.decode(("GST ", 2)), data)
+        self.assertEqual(chunky_file.decoded_cache.misses, 2)
+        self.assertEqual(chunky_file.decoded_cache.hits, 2)
+
+        chunky_file.close()
+        self.assertEqual(len(chunky_file.decoded_cache), 0)
+
+    def test_eviction(self):
+        """ Test that the least recently used values are evicted when the cache is full """
+        decoded_cache = cache.DecodedDataCache(max_size=10)
+        decoded_cache.get("a", 0, lambda: ("a", 4))
+        decoded_cache.get("b", 0, lambda: ("b", 4))
+        decoded_cache.get("a", 0, lambda: ("x", 4))
+        decoded_cache.get("c", 0, lambda: ("c", 4))
+
+        self.assertEqual(decoded_cache.evictions, 1)
+        self.assertEqual(decoded_cache.size, 8)
+        self.assertEqual(decoded_cache.get("a", 0, lambda: ("x", 4)), "a")
+        self.assertEqual(decoded_cache.get("b", 0, lambda: ("b2", 4)), "b2")
+
+        # Values bigger than the cache are not kept
+        decoded_cache.get("d", 0, lambda: ("d", 11))
+        self.assertNotIn("d", [k for k in decoded_cache._entries])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import os
+import pathlib
+import shutil
+import tempfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+import pymaginopolis.chunkyfile.loader as loader
+from pymaginopolis.chunkyfile.common import FileParseException
+from pymaginopolis.chunkyfile.reader import ChunkyReader
+
+
+class ChunkyReaderTests(unittest.TestCase):
+
+    @staticmethod
+    def get_data_dir():
+        return pathlib.Path(__file__).parent / "data"
+
+    def test_concurrent_reads(self):
+        """ Test reading chunks from several threads through one reader """
+        movie_file_path = self.get_data_dir() / "unittest.3mm"
+
+        with open(movie_file_path, "rb") as movie_file:
+            expected_file = loader.load_from_file(movie_file)
+        expected_data = {c.chunk_id: c.raw_data for c in expected_file.chunks}
+
+        # Use a small cache so that chunks get evicted
+        with ChunkyReader(movie_file_path, cache_size=0x100) as reader:
+            chunky_files = [reader.load() for _ in range(0, 8)]
+            chunks = [c for chunky_file in chunky_files for c in chunky_file.chunks]
+            self.assertFalse(any(c.is_loaded for c in chunks))
+
+            with ThreadPoolExecutor(max_workers=4) as pool:
+                for chunk, data in zip(chunks, pool.map(lambda c: c.raw_data, chunks)):
+                    self.assertEqual(data, expected_data[chunk.chunk_id])
+
+    def test_truncated_file(self):
+        """ Test that reading chunk data past the end of a truncated file is an error """
+        with tempfile.TemporaryDirectory() as temp_dir:
+            movie_file_path = pathlib.Path(temp_dir) / "unittest.3mm"
+            shutil.copyfile(self.get_data_dir() / "unittest.3mm", movie_file_path)
+
+            with ChunkyReader(movie_file_path) as reader:
+                chunky_file = reader.load()
+                last_chunk = max(chunky_file.chunks, key=lambda c: c.stored_location)
+                offset, size = last_chunk.stored_location
+                os.truncate(movie_file_path, offset + size // 2)
+                with self.assertRaises(FileParseException):
+                    last_chunk.raw_data
+
+            # Reads fail once the reader is closed
+            with self.assertRaises(ValueError):
+                reader.read(0, 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
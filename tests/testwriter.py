@@ -0,0 +1,256 @@
+import io
+import os
+import pathlib
+import shutil
+import tempfile
+import threading
+import unittest
+
+import pymaginopolis.chunkyfile.loader as loader
+import pymaginopolis.chunkyfile.model as filemodel
+import pymaginopolis.chunkyfile.writer as writer
+
+
+class UnseekableStream(io.RawIOBase):
+    """ Stream that can only be written to, like a pipe """
+
+    def __init__(self):
+        self.data = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.data += data
+        return len(data)
+
+
+class ChunkyWriterTests(unittest.TestCase):
+
+    @staticmethod
+    def get_data_dir():
+        return pathlib.Path(__file__).parent / "data"
+
+    def assertSameChunks(self, chunky_file, other_file):
+        self.assertEqual(sorted(c.chunk_id for c in chunky_file.chunks), sorted(c.chunk_id for c in other_file.chunks))
+        for chunk in chunky_file.chunks:
+            other_chunk = other_file[chunk.chunk_id]
+            self.assertEqual(bytes(other_chunk.raw_data), bytes(chunk.raw_data))
+            self.assertEqual(other_chunk.name, chunk.name)
+            self.assertEqual(other_chunk.flags, chunk.flags)
+            self.assertEqual(other_chunk.children, chunk.children)
+
+    def test_write(self):
+        """ Test that a chunky file can be loaded again after it is written """
+        chunky_file = loader.load_from_path(self.get_data_dir() / "unittest.3mm")
+        output = io.BytesIO()
+        writer.write_to_file(chunky_file, output)
+
+        output.seek(0)
+        self.assertSameChunks(chunky_file, loader.load_from_file(output))
+
+    def test_write_short_data(self):
+        """ Test that chunk data that is shorter than its recorded size is an error """
+        chunky_file = loader.load_from_path(self.get_data_dir() / "unittest.3mm")
+        # Data source that was cut short, eg. a truncated file
+        truncated_source = loader.ViewDataSource(memoryview(b'short'))
+        chunky_file[("GST ", 2)].defer_data(truncated_source, 0, 0x100)
+        with self.assertRaises(ValueError):
+            writer.write_to_file(chunky_file, io.BytesIO())
+
+        chunky_file[("GST ", 2)].defer_data(truncated_source, 0, 0x100)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            with open(pathlib.Path(temp_dir) / "output.3mm", "w+b") as output_file:
+                with self.assertRaises(ValueError):
+                    writer.write_mapped(chunky_file, output_file)
+
+    def test_write_parent_counts(self):
+        """ Test that the number of parents is up to date when children are changed after saving """
+        chunky_file = loader.load_from_path(self.get_data_dir() / "unittest.3mm")
+        thumbnail_id = filemodel.ChunkId("THUM", 0)
+        writer.write_to_file(chunky_file, io.BytesIO())
+        parent_count = chunky_file.count_parents(thumbnail_id)
+
+        string_table_chunk = chunky_file[("GST ", 2)]
+        string_table_chunk.children = string_table_chunk.children + (filemodel.ChunkChild(chid=0, ref=thumbnail_id),)
+        output = io.BytesIO()
+        writer.write_to_file(chunky_file, output)
+
+        file_header = loader.parse_file_header(output.getvalue()[0:loader.FILE_HEADER_SIZE])
+        _, attributes_data, entries_data = loader.read_index_data(output, file_header["index_offset"],
+                                                                  file_header["index_size"])
+        for attributes_offset, attributes_size in loader.INDEX_ENTRY.iter_unpack(entries_data):
+            attributes = loader.parse_chunk_attributes(attributes_data[attributes_offset:
+                                                                       attributes_offset + attributes_size])
+            if (attributes["tag"], attributes["number"]) == thumbnail_id:
+                self.assertEqual(attributes["parents"], parent_count + 1)
+                break
+        else:
+            self.fail("Thumbnail chunk is missing")
+
+    def test_write_unseekable(self):
+        """ Test writing a chunky file to a stream that can't seek """
+        chunky_file = loader.load_from_path(self.get_data_dir() / "unittest.3mm")
+        expected = io.BytesIO()
+        writer.write_to_file(chunky_file, expected)
+
+        output = UnseekableStream()
+        writer.write_to_file(chunky_file, output)
+        self.assertEqual(bytes(output.data), expected.getvalue())
+
+    def test_write_pipe_from_template(self):
+        """ Test copying chunk data from a template into a pipe """
+        movie_file_path = self.get_data_dir() / "unittest.3mm"
+        expected = io.BytesIO()
+        writer.write_to_file(loader.load_from_path(movie_file_path), expected)
+
+        read_fd, write_fd = os.pipe()
+        received = bytearray()
+        reader = threading.Thread(target=lambda: received.extend(os.fdopen(read_fd, "rb").read()))
+        reader.start()
+        with loader.load_from_path(movie_file_path, lazy=True) as chunky_file:
+            with open(movie_file_path, "rb") as template_file, open(write_fd, "wb") as output_file:
+                writer.write_to_file(chunky_file, output_file, template=template_file)
+        reader.join()
+        self.assertEqual(bytes(received), expected.getvalue())
+
+    def test_write_from_template(self):
+        """ Test that copying unmodified chunk data from the template gives the same file as writing it """
+        movie_file_path = self.get_data_dir() / "unittest.3mm"
+        chunky_file = loader.load_from_path(movie_file_path)
+        chunky_file[("GST ", 2)].raw_data = b'modified string table'
+        expected = io.BytesIO()
+        writer.write_to_file(chunky_file, expected)
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            output_path = pathlib.Path(temp_dir) / "output.3mm"
+            with loader.load_from_path(movie_file_path, lazy=True) as chunky_file:
+                chunky_file[("GST ", 2)].raw_data = b'modified string table'
+                with open(movie_file_path, "rb") as template_file, open(output_path, "wb") as output_file:
+                    writer.write_to_file(chunky_file, output_file, template=template_file)
+                # Only the modified chunk was read
+                self.assertEqual([c.chunk_id for c in chunky_file.chunks if c.is_loaded],
+                                 [filemodel.ChunkId("GST ", 2)])
+            self.assertEqual(output_path.read_bytes(), expected.getvalue())
+
+        # Buffered copy for files that aren't real files
+        with loader.load_from_path(movie_file_path, lazy=True) as chunky_file:
+            chunky_file[("GST ", 2)].raw_data = b'modified string table'
+            output = io.BytesIO()
+            writer.write_to_file(chunky_file, output, template=io.BytesIO(movie_file_path.read_bytes()))
+            self.assertEqual(output.getvalue(), expected.getvalue())
+
+    def test_write_twice_from_template(self):
+        """ Test that saving again with the same template still copies the right data from it """
+        movie_file_path = self.get_data_dir() / "unittest.3mm"
+        with tempfile.TemporaryDirectory() as temp_dir:
+            output_path = pathlib.Path(temp_dir) / "output.3mm"
+            for write in [writer.write_to_file, writer.write_mapped]:
+                with loader.load_from_path(movie_file_path, lazy=True) as chunky_file:
+                    # Moves the data of every other chunk in the output
+                    first_chunk = chunky_file.chunks[0]
+                    first_chunk.raw_data = bytes(first_chunk.raw_data) + b'grown'
+                    with open(movie_file_path, "rb") as template_file:
+                        for _ in range(0, 2):
+                            with open(output_path, "w+b") as output_file:
+                                write(chunky_file, output_file, template=template_file)
+                            self.assertSameChunks(chunky_file, loader.load_from_path(output_path))
+
+    def test_write_mapped(self):
+        """ Test that writing through a memory mapped output gives the same file as write_to_file """
+        movie_file_path = self.get_data_dir() / "unittest.3mm"
+        chunky_file = loader.load_from_path(movie_file_path)
+        chunky_file[("GST ", 2)].raw_data = b'modified string table'
+        expected = io.BytesIO()
+        writer.write_to_file(chunky_file, expected)
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            output_path = pathlib.Path(temp_dir) / "output.3mm"
+            for jobs in [1, 4]:
+                # Start with a file that is bigger than the output
+                output_path.write_bytes(b'\xff' * 0x10000)
+                with open(output_path, "r+b") as output_file:
+                    writer.write_mapped(chunky_file, output_file, jobs=jobs)
+                self.assertEqual(output_path.read_bytes(), expected.getvalue())
+
+                with loader.load_from_path(movie_file_path, lazy=True) as lazy_file:
+                    lazy_file[("GST ", 2)].raw_data = b'modified string table'
+                    with open(movie_file_path, "rb") as template_file, open(output_path, "w+b") as output_file:
+                        writer.write_mapped(lazy_file, output_file, template=template_file, jobs=jobs)
+                    self.assertEqual(len([c for c in lazy_file.chunks if c.is_loaded]), 1)
+                self.assertEqual(output_path.read_bytes(), expected.getvalue())
+
+    def test_write_deduplicated(self):
+        """ Test that chunks with identical data share one copy of it """
+        chunky_file = loader.load_from_path(self.get_data_dir() / "unittest.3mm")
+        string_table = bytes(chunky_file[("GST ", 2)].raw_data)
+        chunky_file.add_chunk(filemodel.Chunk("GST ", 100, data=string_table))
+        chunky_file.add_chunk(filemodel.Chunk("GST ", 101, data=string_table))
+        # Same size, different data
+        chunky_file.add_chunk(filemodel.Chunk("GST ", 102, data=bytes(len(string_table))))
+        self.assertEqual(writer.find_duplicate_chunks(chunky_file), {
+            filemodel.ChunkId("GST ", 100): filemodel.ChunkId("GST ", 2),
+            filemodel.ChunkId("GST ", 101): filemodel.ChunkId("GST ", 2)})
+
+        not_deduplicated = io.BytesIO()
+        self.assertEqual(writer.write_to_file(chunky_file, not_deduplicated), 0)
+        output = io.BytesIO()
+        bytes_saved = writer.write_to_file(chunky_file, output, deduplicate=True)
+        self.assertEqual(bytes_saved, 2 * len(string_table))
+        self.assertEqual(len(output.getvalue()), len(not_deduplicated.getvalue()) - bytes_saved)
+        self.assertEqual(chunky_file[("GST ", 100)].stored_location, chunky_file[("GST ", 2)].stored_location)
+
+        output.seek(0)
+        self.assertSameChunks(chunky_file, loader.load_from_file(output))
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            output_path = pathlib.Path(temp_dir) / "output.3mm"
+            with open(output_path, "w+b") as output_file:
+                self.assertEqual(writer.write_mapped(chunky_file, output_file, deduplicate=True), bytes_saved)
+            self.assertEqual(output_path.read_bytes(), output.getvalue())
+
+    def test_write_incremental(self):
+        """ Test saving changes to a chunky file in place """
+        with tempfile.TemporaryDirectory() as temp_dir:
+            movie_file_path = pathlib.Path(temp_dir) / "unittest.3mm"
+            shutil.copyfile(self.get_data_dir() / "unittest.3mm", movie_file_path)
+            original_size = movie_file_path.stat().st_size
+
+            chunky_file = loader.load_from_path(movie_file_path)
+            self.assertFalse(any(c.is_modified for c in chunky_file.chunks))
+            thumbnail_location = chunky_file[("THUM", 0)].stored_location
+
+            # Modify a chunk and add a new one
+            chunky_file[("GST ", 2)].raw_data = b'modified string table'
+            chunky_file.add_chunk(filemodel.Chunk("GLSC", 1, data=b'new script'))
+            self.assertEqual(len([c for c in chunky_file.chunks if c.is_modified]), 2)
+
+            with open(movie_file_path, "r+b") as movie_file:
+                bytes_written = writer.write_incremental(chunky_file, movie_file)
+
+            self.assertFalse(any(c.is_modified for c in chunky_file.chunks))
+            self.assertEqual(chunky_file[("THUM", 0)].stored_location, thumbnail_location)
+            # Only the modified data and the index are written, not the other chunks
+            self.assertLess(bytes_written, original_size // 2)
+            self.assertEqual(movie_file_path.stat().st_size, original_size + bytes_written - writer.FILE_HEADER_SIZE)
+
+            reloaded_file = loader.load_from_path(movie_file_path)
+            self.assertSameChunks(chunky_file, reloaded_file)
+
+            # Save again with no changes
+            with open(movie_file_path, "r+b") as movie_file:
+                writer.write_incremental(reloaded_file, movie_file)
+            self.assertSameChunks(chunky_file, loader.load_from_path(movie_file_path))
+
+    def test_write_incremental_wrong_file(self):
+        """ Test that unmodified chunks must be in the file being updated """
+        chunky_file = loader.load_from_path(self.get_data_dir() / "unittest.3mm")
+        output = io.BytesIO()
+        writer.write_to_file(filemodel.ChunkyFile(filemodel.Endianness.LittleEndian, filemodel.CharacterSet.ANSI),
+                             output)
+        with self.assertRaises(ValueError):
+            writer.write_incremental(chunky_file, output)
+
+
+if __name__ == '__main__':
+    unittest.main()